@@ -1,3 +1,4 @@
+import argparse
 import requests
 import datetime
 from datetime import datetime, timedelta
@@ -5,20 +6,37 @@ from dateutil.relativedelta import relativedelta
 from pytz import timezone
 import csv
 import os
+import sys
 import MySQLdb
 import time
 import json
+import hashlib
+import sqlite3
 import inspect
+import functools
+import itertools
+import contextlib
+import difflib
+import unicodedata
 import re
 import random
 import string
-from bs4 import BeautifulSoup
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import urllib.parse
+import email.utils
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
-from requests.exceptions import HTTPError
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+# Optional: transliterates non-Latin names for fuzzy matching
+try:
+    from unidecode import unidecode
+except ImportError:
+    unidecode = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -43,27 +61,573 @@ SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI')
 # Last.fm API key
 LASTFM_API_KEY = os.getenv('LASTFM_API_KEY')
 
+# Last.fm API endpoint (can be pointed at a local stub server for testing)
+LASTFM_API_URL = os.getenv('LASTFM_API_URL', 'https://ws.audioscrobbler.com/2.0/')
+
+# Last.fm asks for no more than 5 requests per second per client
+LASTFM_RATE_LIMIT = float(os.getenv('LASTFM_RATE_LIMIT', 5))
+LASTFM_FETCH_WORKERS = int(os.getenv('LASTFM_FETCH_WORKERS', 4))
+
+# 'incremental' appends scrobbles newer than each user's sync cursor,
+# 'window' deletes and re-downloads the playlist's whole date window
+LASTFM_SYNC_MODE = os.getenv('LASTFM_SYNC_MODE', 'incremental')
+
 # Odesli API key
 ODESLI_API_KEY = os.getenv('ODESLI_API_KEY')
 
+# Odesli requests per second, concurrent lookups, albums written per batch, and days
+# before an album without a Bandcamp link is looked up again
+ODESLI_RATE_LIMIT = float(os.getenv('ODESLI_RATE_LIMIT', 1))
+ODESLI_WORKERS = int(os.getenv('ODESLI_WORKERS', 4))
+ODESLI_BATCH = int(os.getenv('ODESLI_BATCH', 50))
+BANDCAMP_RECHECK_DAYS = int(os.getenv('BANDCAMP_RECHECK_DAYS', 30))
+
+# Albums looked up on Odesli for a Bandcamp link per run; the rest wait for later runs
+BANDCAMP_ENRICH_ALBUMS = int(os.getenv('BANDCAMP_ENRICH_ALBUMS', 200))
+
+# Albums whose Bandcamp page is read for missing track durations per run
+BANDCAMP_DURATION_ALBUMS = int(os.getenv('BANDCAMP_DURATION_ALBUMS', 200))
+
+# Local cache of API responses shared across runs
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', 'response_cache.sqlite')
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 200000))
+
+# Seconds to keep (found, not found) responses per source
+RESPONSE_CACHE_TTLS = {
+    'spotify_search': (30 * 86400, 7 * 86400),
+    'spotify_album_search': (30 * 86400, 7 * 86400),
+    'spotify_album': (90 * 86400, 7 * 86400),
+    'odesli': (90 * 86400, 30 * 86400),
+    'bandcamp_ld_json': (180 * 86400, 14 * 86400),
+    'lastfm_track_info': (180 * 86400, 30 * 86400),
+}
+
+# Rows per bulk INSERT, and last_fm_data ids scanned per watermark step
+BULK_INSERT_CHUNK = int(os.getenv('BULK_INSERT_CHUNK', 1000))
+WATERMARK_SCAN_ROWS = int(os.getenv('WATERMARK_SCAN_ROWS', 50000))
+
+# Number of worker threads used for the per-user sync and playlist stages
+# (1 runs everything serially), and the most database connections open at once.
+# The main thread keeps a connection while every worker holds one, so the pool
+# is never smaller than PIPELINE_WORKERS + 1
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', 4))
+DB_POOL_SIZE = max(int(os.getenv('DB_POOL_SIZE', PIPELINE_WORKERS + 1)), PIPELINE_WORKERS + 1)
+# Seconds to wait for a free pooled connection before giving up
+DB_CHECKOUT_TIMEOUT = float(os.getenv('DB_CHECKOUT_TIMEOUT', 300))
+
+# Rows fetched per page when the enrichment stages stream their work queues
+ENRICH_PAGE_SIZE = int(os.getenv('ENRICH_PAGE_SIZE', 1000))
+
+# Spotify's bulk endpoints take at most 50 track IDs (tracks) and 100 (audio features) per request
+SPOTIFY_TRACKS_BATCH = 50
+SPOTIFY_FEATURES_BATCH = 100
+
+# Track matching engine: 'fuzzy' (Unicode-aware similarity) or 'token' (exact word overlap)
+MATCH_ENGINE = os.getenv('MATCH_ENGINE', 'fuzzy')
+
+# Unmatched tracks wait SPOTIFY_RETRY_BASE_DAYS before their first retry, doubling after each
+# failed retry up to SPOTIFY_RETRY_MAX_DAYS; at most SPOTIFY_SEARCH_BUDGET searches per run (0 = no limit)
+SPOTIFY_RETRY_BASE_DAYS = int(os.getenv('SPOTIFY_RETRY_BASE_DAYS', 7))
+SPOTIFY_RETRY_MAX_DAYS = int(os.getenv('SPOTIFY_RETRY_MAX_DAYS', 180))
+SPOTIFY_SEARCH_BUDGET = int(os.getenv('SPOTIFY_SEARCH_BUDGET', 2000))
+
+# Top-ranked albums per playlist treated as candidates for its next build
+PLAYLIST_CANDIDATE_ALBUMS = int(os.getenv('PLAYLIST_CANDIDATE_ALBUMS', 32))
+
+# 'full' enriches every recently played track and album, 'demand' only the playlist candidate albums
+ENRICH_MODE = os.getenv('ENRICH_MODE', 'full')
+
+# Albums with at least this many unmatched tracks are resolved from one album listing instead of per-track searches
+ALBUM_RESOLVE_MIN_TRACKS = int(os.getenv('ALBUM_RESOLVE_MIN_TRACKS', 2))
+
+# Listening time counted for a play whose track has no known duration yet
+UNKNOWN_DURATION_MS = 240000
+
+# Ranked albums resolved per set-based track selection query when building a playlist
+PLAYLIST_SELECT_BATCH = int(os.getenv('PLAYLIST_SELECT_BATCH', 48))
+
+# Enrichment stages commit after this many writes, or once the oldest uncommitted write is this old
+COMMIT_EVERY_ROWS = int(os.getenv('COMMIT_EVERY_ROWS', 500))
+COMMIT_EVERY_SECONDS = float(os.getenv('COMMIT_EVERY_SECONDS', 5))
+
+# Spotify requests per second, and the rate for hosts without their own limit (e.g. Bandcamp pages)
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', 10))
+HTTP_DEFAULT_RATE_LIMIT = float(os.getenv('HTTP_DEFAULT_RATE_LIMIT', 2))
+
+# Requests per second per API host; subdomains share their parent's entry
+HTTP_HOST_RATES = {
+    urllib.parse.urlsplit(LASTFM_API_URL).hostname: LASTFM_RATE_LIMIT,
+    'api.song.link': ODESLI_RATE_LIMIT,
+    'spotify.com': SPOTIFY_RATE_LIMIT,
+}
+
+# Retries after a 429, 5xx or connection error; the backoff starts at HTTP_BACKOFF_BASE seconds
+# and doubles per attempt up to HTTP_BACKOFF_MAX, which also caps how long a Retry-After is honored
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 4))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', 1))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 60))
+
+# Seconds to wait for a connection, and for each read from it
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+
+# A host failing this many requests in a row is not called again for HTTP_CIRCUIT_COOLDOWN seconds
+HTTP_CIRCUIT_FAILURES = int(os.getenv('HTTP_CIRCUIT_FAILURES', 5))
+HTTP_CIRCUIT_COOLDOWN = float(os.getenv('HTTP_CIRCUIT_COOLDOWN', 60))
+
+# Per-stage run metrics are appended to METRICS_PATH as JSON lines (empty disables); set
+# METRICS_PROM_PATH to also write them in Prometheus text format, e.g. for node_exporter's textfile collector
+METRICS_PATH = os.getenv('METRICS_PATH', 'pipeline_metrics.jsonl')
+METRICS_PROM_PATH = os.getenv('METRICS_PROM_PATH', '')
+
 # =============================================================================
-# GLOBAL VARIABLES & DATABASE CONNECTION
+# METRICS
 # =============================================================================
 
-# Define global variables for database connection
-dtdb = None
-curdt = None
-
-def connect_to_db():
-    """Establish database connection and return cursor."""
-    global dtdb, curdt
-    dtdb = MySQLdb.Connection(**DB_CONFIG)
-    curdt = dtdb.cursor()
-    dtdb.set_character_set('utf8')
-    curdt.execute('SET NAMES utf8;')
-    curdt.execute('SET CHARACTER SET utf8;')
-    curdt.execute('SET character_set_connection=utf8;')
-    return dtdb, curdt
+class Metrics:
+    """
+    Wall time and its split into phases, rows processed, API calls and retries by host,
+    response cache hits and misses, database query time and commits, and playlist outcomes
+    for each pipeline stage. Counters go to the stage open on the calling thread; work a
+    stage hands to a thread pool is counted by submitting it through bind().
+    """
+
+    COUNTERS = ('phases', 'api_calls', 'retries', 'cache_hits', 'cache_misses', 'playlists')
+    FIELDS = ('seconds', 'rows', 'db_queries', 'db_seconds', 'commits', 'committed_writes')
+
+    def __init__(self, path, prom_path):
+        self.path = path
+        self.prom_path = prom_path
+        self.run_id = None
+        self.records = []
+        self.current = threading.local()
+        self.lock = threading.Lock()
+
+    def count(self, counter, key=None, amount=1):
+        """Add amount to a counter of the current thread's stage, per key for the keyed counters."""
+        record = getattr(self.current, 'record', None)
+        if record is None:
+            return
+        with self.lock:
+            if key is None:
+                record[counter] += amount
+            else:
+                record[counter][key] = record[counter].get(key, 0) + amount
+
+    def rows(self, amount):
+        """Count rows (tracks, albums, scrobbles) processed by the current stage."""
+        self.count('rows', amount=amount)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to the current stage's phase name."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.count('phases', name, time.monotonic() - start)
+
+    def bind(self, func):
+        """Wrap func so that calls on another thread count towards the current stage."""
+        record = getattr(self.current, 'record', None)
+        
+        @functools.wraps(func)
+        def bound(*args, **kwargs):
+            previous = getattr(self.current, 'record', None)
+            self.current.record = record
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.current.record = previous
+        return bound
+
+    @contextlib.contextmanager
+    def stage(self, stage, job=None):
+        """Measure the block as one stage (of one job) and emit its record when it ends."""
+        record = {'stage': stage, 'job': job, 'ok': True, 'error': None}
+        record.update((field, 0) for field in self.FIELDS)
+        record.update((counter, {}) for counter in self.COUNTERS)
+        previous = getattr(self.current, 'record', None)
+        self.current.record = record
+        start = time.monotonic()
+        try:
+            yield record
+        except Exception as e:
+            record['ok'] = False
+            record['error'] = str(e)
+            raise
+        finally:
+            record['seconds'] = time.monotonic() - start
+            self.current.record = previous
+            self.emit(record)
+
+    def emit(self, record):
+        """Keep a finished stage record and append it to the JSON lines file."""
+        line = dict(record, run_id=self.run_id, finished_at=whattimeisit(),
+                    seconds=round(record['seconds'], 3), db_seconds=round(record['db_seconds'], 3),
+                    phases={name: round(seconds, 3) for name, seconds in record['phases'].items()})
+        with self.lock:
+            self.records.append(record)
+            if not self.path:
+                return
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(line) + '\n')
+            except OSError as e:
+                print(f"{lineno()} - Could not write metrics to {self.path}: {e}")
+
+    def totals(self):
+        """Sum the records of the run per stage."""
+        totals = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record['stage'], dict({'jobs': 0, 'failed': 0}, **{field: 0 for field in self.FIELDS}))
+            total['jobs'] += 1
+            total['failed'] += 0 if record['ok'] else 1
+            for field in self.FIELDS:
+                total[field] += record[field]
+            for counter in self.COUNTERS:
+                keyed = total.setdefault(counter, {})
+                for key, amount in record[counter].items():
+                    keyed[key] = keyed.get(key, 0) + amount
+        return totals
+
+    def print_summary(self):
+        """Print the run's per-stage totals, then the jobs that failed."""
+        print("\nPipeline summary:")
+        for stage, total in self.totals().items():
+            api_calls = ', '.join(f"{host} {calls}" for host, calls in total['api_calls'].items()) or 'none'
+            print(f"  {stage:<24} {total['seconds']:8.2f}s {total['rows']:>7} rows  "
+                  f"db {total['db_queries']} queries {total['db_seconds']:.2f}s {total['commits']} commits  "
+                  f"api {api_calls}  retries {sum(total['retries'].values())}  "
+                  f"cache {sum(total['cache_hits'].values())} hits/{sum(total['cache_misses'].values())} misses")
+            if total['phases']:
+                print("    " + ', '.join(f"{name} {seconds:.2f}s" for name, seconds in total['phases'].items()))
+            if total['playlists']:
+                print("    playlists " + ', '.join(f"{count} {status}" for status, count in total['playlists'].items()))
+        with self.lock:
+            jobs = [record for record in self.records if record['job'] is not None]
+        failed = [record for record in jobs if not record['ok']]
+        for record in failed:
+            print(f"  FAILED {record['stage']} {record['job']}: {record['error']}")
+        print(f"  {len(jobs) - len(failed)} jobs succeeded, {len(failed)} failed")
+
+    def write_prometheus(self, run_seconds):
+        """Write the run's per-stage totals to prom_path, replacing the previous run's file."""
+        if not self.prom_path:
+            return
+        metrics = {}
+        
+        def add(name, help_text, labels, value):
+            samples = metrics.setdefault(name, (help_text, []))[1]
+            label_text = ','.join(f'{label}="{prometheus_label(label_value)}"' for label, label_value in labels.items())
+            samples.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        
+        add('music_inventory_run_seconds', 'Wall time of the last pipeline run.', {}, round(run_seconds, 3))
+        for stage, total in self.totals().items():
+            labels = {'stage': stage}
+            add('music_inventory_stage_seconds', 'Wall time per stage, summed over its jobs.', labels, round(total['seconds'], 3))
+            add('music_inventory_stage_jobs', 'Jobs run per stage.', labels, total['jobs'])
+            add('music_inventory_stage_failed_jobs', 'Jobs that failed per stage.', labels, total['failed'])
+            add('music_inventory_stage_rows', 'Rows processed per stage.', labels, total['rows'])
+            add('music_inventory_stage_db_queries', 'Database queries per stage.', labels, total['db_queries'])
+            add('music_inventory_stage_db_seconds', 'Time spent in database queries per stage.', labels, round(total['db_seconds'], 3))
+            add('music_inventory_stage_commits', 'Database commits per stage.', labels, total['commits'])
+            add('music_inventory_stage_committed_writes', 'Writes committed in batches per stage.', labels, total['committed_writes'])
+            for phase, seconds in total['phases'].items():
+                add('music_inventory_stage_phase_seconds', 'Wall time per stage and phase, summed over its jobs.', dict(labels, phase=phase), round(seconds, 3))
+            for host, calls in total['api_calls'].items():
+                add('music_inventory_stage_api_calls', 'HTTP requests per stage and host, retries included.', dict(labels, host=host), calls)
+            for host, retries in total['retries'].items():
+                add('music_inventory_stage_api_retries', 'Retried HTTP requests per stage and host.', dict(labels, host=host), retries)
+            for source, hits in total['cache_hits'].items():
+                add('music_inventory_stage_cache_hits', 'Response cache hits per stage and source.', dict(labels, source=source), hits)
+            for source, misses in total['cache_misses'].items():
+                add('music_inventory_stage_cache_misses', 'Response cache misses per stage and source.', dict(labels, source=source), misses)
+            for status, count in total['playlists'].items():
+                add('music_inventory_stage_playlists', 'Playlists per stage and sync outcome.', dict(labels, status=status), count)
+        
+        lines = []
+        for name, (help_text, samples) in metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        # Write then rename so a scraper never reads a half-written file
+        try:
+            with open(self.prom_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(self.prom_path + '.tmp', self.prom_path)
+        except OSError as e:
+            print(f"{lineno()} - Could not write metrics to {self.prom_path}: {e}")
+
+def prometheus_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics(METRICS_PATH, METRICS_PROM_PATH)
+
+# =============================================================================
+# DATABASE CONNECTION
+# =============================================================================
+
+# MySQL client errors meaning the connection is gone: server has gone away, lost connection during query
+DB_RECONNECT_ERRORS = (2006, 2013)
+
+class PoolTimeoutError(MySQLdb.OperationalError):
+    """Raised when no pooled connection frees up within DB_CHECKOUT_TIMEOUT."""
+
+class DBPool:
+    """
+    Pool of MySQL connections shared by the pipeline threads. Connections are opened on
+    demand up to size, pinged when checked out and replaced if they have gone stale.
+    """
+
+    def __init__(self, config, size, timeout=None):
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Open a new connection with the session character set configured."""
+        conn = MySQLdb.Connection(**self.config)
+        conn.set_character_set('utf8')
+        cursor = conn.cursor()
+        cursor.execute('SET NAMES utf8;')
+        cursor.execute('SET CHARACTER SET utf8;')
+        cursor.execute('SET character_set_connection=utf8;')
+        cursor.close()
+        return conn
+
+    def open_connection(self):
+        """Take a slot in the pool and open a connection for it, giving the slot back if that fails."""
+        with self.lock:
+            self.opened += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def checkout(self):
+        """Take an idle connection, opening one if the pool isn't full, else wait for one."""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if not can_open:
+                try:
+                    conn = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeoutError(f'No database connection free after {self.timeout}s with {self.size} open') from None
+            else:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+        
+        try:
+            conn.ping()
+        except MySQLdb.Error:
+            print("Pooled database connection went stale, reconnecting")
+            self.discard(conn)
+            conn = self.open_connection()
+        return conn
+
+    def checkin(self, conn):
+        self.idle.put(conn)
+
+    def discard(self, conn):
+        """Drop a broken connection from the pool."""
+        with self.lock:
+            self.opened -= 1
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    @contextlib.contextmanager
+    def session(self):
+        """Check out a connection as a DBSession and return it to the pool afterwards."""
+        session = DBSession(self, self.checkout())
+        try:
+            yield session
+            session.uow.flush()
+        finally:
+            session.release()
+
+class DBSession:
+    """
+    One pooled connection and its cursor, passed to every function as db.
+    A query that fails because the connection dropped is retried once on a fresh
+    connection, as long as there were no uncommitted writes to lose.
+    """
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.dirty = False
+        self.uow = UnitOfWork(self, COMMIT_EVERY_ROWS, COMMIT_EVERY_SECONDS)
+
+    def _run(self, method, sql, params):
+        start = time.monotonic()
+        try:
+            result = getattr(self.cursor, method)(sql, params)
+        except MySQLdb.OperationalError as e:
+            if e.args[0] not in DB_RECONNECT_ERRORS or self.dirty:
+                raise
+            print(f"Database connection lost ({e.args[0]}), reconnecting")
+            self.reconnect()
+            result = getattr(self.cursor, method)(sql, params)
+        finally:
+            metrics.count('db_queries')
+            metrics.count('db_seconds', amount=time.monotonic() - start)
+        if not sql.lstrip().upper().startswith(('SELECT', 'EXPLAIN', 'SHOW')):
+            self.dirty = True
+        return result
+
+    def execute(self, sql, params=None):
+        return self._run('execute', sql, params)
+
+    def executemany(self, sql, rows):
+        return self._run('executemany', sql, rows)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def commit(self):
+        start = time.monotonic()
+        self.conn.commit()
+        metrics.count('db_seconds', amount=time.monotonic() - start)
+        self.dirty = False
+
+    def rollback(self):
+        self.conn.rollback()
+        self.dirty = False
+
+    def reconnect(self):
+        self.pool.discard(self.conn)
+        # The old connection's slot is already given back if the new one can't be opened
+        self.conn = None
+        self.conn = self.pool.open_connection()
+        self.cursor = self.conn.cursor()
+        self.dirty = False
+
+    def release(self):
+        """Return the connection to the pool, discarding anything left uncommitted."""
+        if self.conn is None:
+            return
+        try:
+            self.cursor.close()
+            self.conn.rollback()
+        except MySQLdb.Error:
+            self.pool.discard(self.conn)
+            return
+        self.pool.checkin(self.conn)
+
+class UnitOfWork:
+    """
+    Coalesces commits for the enrichment stages. Inside stage() writes are committed every
+    max_rows writes or max_seconds, and whatever is left when the stage ends (or fails).
+    Outside a stage every write is committed straight away.
+
+    The stages only issue idempotent writes (UPDATEs keyed on a row, INSERT IGNOREs) and pick
+    their work from rows that are still unfinished, so a run that dies loses at most the last
+    uncommitted batch and the next run simply redoes it.
+    """
+
+    def __init__(self, db, max_rows, max_seconds):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.current = None
+        self.pending = 0
+        self.oldest = None
+
+    def execute(self, sql, params=None):
+        self.db.execute(sql, params)
+        self._written(1)
+
+    def executemany(self, sql, rows):
+        if rows:
+            self.db.executemany(sql, rows)
+            self._written(len(rows))
+
+    def _written(self, rows):
+        if self.pending == 0:
+            self.oldest = time.monotonic()
+        self.pending += rows
+        if (self.current is None or self.pending >= self.max_rows
+                or time.monotonic() - self.oldest >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        """Commit all pending writes."""
+        if self.pending == 0:
+            return
+        self.db.commit()
+        metrics.count('commits')
+        metrics.count('committed_writes', amount=self.pending)
+        self.pending = 0
+        self.oldest = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Batch the commits of the writes made inside the block under one stage name."""
+        previous = self.current
+        self.flush()
+        self.current = name
+        try:
+            yield self
+        finally:
+            # Completed writes are kept even when the stage fails part way
+            self.flush()
+            self.current = previous
+
+db_pool = DBPool(DB_CONFIG, DB_POOL_SIZE, DB_CHECKOUT_TIMEOUT)
+
+def iter_keyset(db, sql, key, params=(), page_size=None):
+    """
+    Stream the rows of a query in keyset-paginated pages, so a large backlog is never held
+    in memory and work can start on the first page. sql must select the key columns first
+    and leave an {after} placeholder at the end of its WHERE clause; ORDER BY and LIMIT are added here.
+    """
+    page_size = page_size or ENRICH_PAGE_SIZE
+    width = len(key.split(','))
+    last = None
+    while True:
+        after = '' if last is None else f"AND ({key}) > ({', '.join(['%s'] * width)})"
+        db.execute(f"{sql.format(after=after)} ORDER BY {key} LIMIT {page_size}", tuple(params) + tuple(last or ()))
+        rows = db.fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1][:width]
 
 # =============================================================================
 # UTILITY FUNCTIONS
@@ -78,17 +642,12 @@ def whattimeisit():
     now = datetime.now()
     return now.strftime("%Y-%m-%d %H:%M:%S")
 
-def log_error(message, row_err):
+def log_error(db, message, row_err):
     """Log errors to the database."""
-    global dtdb, curdt
     try:
-        # Make sure database is connected
-        if dtdb is None or curdt is None:
-            connect_to_db()
-            
         sql = "INSERT INTO music_inventory.error_log(log_row, error) VALUES(%s, %s)"
-        curdt.execute(sql, (row_err, message))
-        dtdb.commit()
+        # Batched with the current stage's writes, committed immediately otherwise
+        db.uow.execute(sql, (row_err, message))
     except Exception as e:
         print(message, row_err)
         print(lineno(), e)
@@ -104,6 +663,57 @@ def create_pl_code():
     random.shuffle(password)
     return "".join(password)
 
+class TokenBucket:
+    """Thread-safe token bucket used to pace requests to an API."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        """Change the refill rate, keeping the tokens accrued at the old rate."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = float(rate)
+
+def chunked(items, size):
+    """Yield successive lists of at most size items; works on any iterable, including generators."""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def unique(items):
+    """Yield items in order, skipping repeats."""
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+# Characters normalize_string replaces with spaces
+NON_ALNUM_RE = re.compile(r'[^a-z0-9\s]')
+
 def normalize_string(s):
     """
     Normalize string by:
@@ -114,57 +724,485 @@ def normalize_string(s):
     # Convert to lowercase first
     s = s.lower()
     # Replace all non-alphanumeric characters (except spaces) with spaces
-    s = re.sub(r'[^a-z0-9\s]', ' ', s)
+    s = NON_ALNUM_RE.sub(' ', s)
     # Normalize whitespace (remove extra spaces)
     s = ' '.join(s.split())
     return s
 
-def is_match(result, artist, album, track, check_album=True):
+@functools.lru_cache(maxsize=65536)
+def normalize_tokens(s):
+    """Return the normalized form of s and its set of words, cached across calls."""
+    norm = normalize_string(s)
+    return norm, frozenset(norm.split())
+
+def word_match_ratio(parts, result_parts):
+    """Share of words two normalized strings have in common."""
+    longest = max(len(parts), len(result_parts))
+    if not longest:
+        return 0.0
+    return len(parts & result_parts) / longest
+
+class TrackMatcher:
     """
-    Check if a search result matches the target track.
-    check_album: if False, skip album verification
+    Matches Spotify results against one target track.
+    The target is normalized once; candidate strings go through the normalize_tokens cache.
     """
-    result_artist = result['artists'][0]['name']
-    result_track = result['name']
-    
-    # Normalize all strings for comparison
-    norm_result_artist = normalize_string(result_artist)
-    norm_result_track = normalize_string(result_track)
-    norm_artist = normalize_string(artist)
-    norm_track = normalize_string(track)
-    
-    # Artist should match exactly after normalization
-    if norm_result_artist != norm_artist:
-        return False
+    # Share of words that must match for the track and album names
+    TRACK_THRESHOLD = 0.7
+    ALBUM_THRESHOLD = 0.5
+
+    def __init__(self, artist, album, track):
+        self.artist = normalize_tokens(artist)[0]
+        self.album, self.album_parts = normalize_tokens(album)
+        self.track_parts = normalize_tokens(track)[1]
+
+    def score(self, result, check_album=True):
+        """
+        Return (track_ratio, album_ratio) for a search result, or None if it doesn't match.
+        check_album: if False, skip album verification
+        """
+        # Artist should match exactly after normalization
+        if normalize_tokens(result['artists'][0]['name'])[0] != self.artist:
+            return None
         
-    # For track matching, compare word sets
-    track_parts = set(norm_track.split())
-    result_track_parts = set(norm_result_track.split())
-    common_words = track_parts.intersection(result_track_parts)
-    
-    # Match threshold - 70% of words should match for track
-    track_match_ratio = len(common_words) / max(len(track_parts), len(result_track_parts))
-    
-    if track_match_ratio < 0.7:
+        # For track matching, compare word sets
+        track_match_ratio = word_match_ratio(self.track_parts, normalize_tokens(result['name'])[1])
+        if track_match_ratio < self.TRACK_THRESHOLD:
+            return None
+        
+        album_match_ratio = 1.0
+        if check_album:
+            norm_result_album, result_album_parts = normalize_tokens(result['album']['name'])
+            if norm_result_album and self.album:
+                album_match_ratio = word_match_ratio(self.album_parts, result_album_parts)
+                if album_match_ratio < self.ALBUM_THRESHOLD:
+                    return None
+        
+        return track_match_ratio, album_match_ratio
+
+    def matches(self, result, check_album=True):
+        """Check if a single search result matches the target track."""
+        return self.score(result, check_album) is not None
+
+    def matches_album(self, result):
+        """Check if a Spotify album search result matches the target album."""
+        if normalize_tokens(result['artists'][0]['name'])[0] != self.artist:
+            return False
+        result_album_parts = normalize_tokens(result['name'])[1]
+        if not self.album_parts or not result_album_parts:
+            return False
+        return word_match_ratio(self.album_parts, result_album_parts) >= self.ALBUM_THRESHOLD
+
+    def best_match(self, results, check_album=True):
+        """Score every candidate and return the best matching result (first wins ties), or None."""
+        best = None
+        best_score = None
+        for result in results:
+            score = self.score(result, check_album)
+            if score is not None and (best_score is None or score > best_score):
+                best = result
+                best_score = score
+        return best
+
+# Edition/remaster suffixes that don't change which recording a title refers to
+EDITION_WORDS = r'(?:remaster(?:ed)?|deluxe|expanded|anniversary|edition|bonus tracks?|reissue)'
+EDITION_SUFFIX_RE = re.compile(r'\s*(?:[\(\[][^\(\)\[\]]*\b' + EDITION_WORDS + r'\b[^\(\)\[\]]*[\)\]]|\s-\s[^-]*\b' + EDITION_WORDS + r'\b.*$)')
+APOSTROPHE_RE = re.compile(r"['’`]")
+NON_WORD_RE = re.compile(r'[\W_]+')
+LEADING_ARTICLE_RE = re.compile(r'^the\s+')
+AMPERSAND_RE = re.compile(r'\s*[&+]\s*')
+
+# Words that tell parts, volumes and sequels apart ("Part 2", "Vol. II", "Chapter Two")
+ROMAN_NUMERAL_RE = re.compile(r'^x{0,3}(?:ix|iv|v?i{0,3})$')
+NUMBER_WORDS = frozenset('one two three four five six seven eight nine ten eleven twelve'.split())
+
+def fold_string(s):
+    """
+    Unicode-aware normalization for fuzzy matching:
+    NFKD case/accent folding, edition suffix removal, optional transliteration
+    (when unidecode is installed) and punctuation removal.
+    """
+    s = unicodedata.normalize('NFKD', s).casefold()
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+    s = EDITION_SUFFIX_RE.sub('', s)
+    if unidecode is not None:
+        transliterated = unidecode(s).lower()
+        if transliterated.strip():
+            s = transliterated
+    s = APOSTROPHE_RE.sub('', s)
+    s = NON_WORD_RE.sub(' ', s)
+    return ' '.join(s.split())
+
+@functools.lru_cache(maxsize=65536)
+def fuzzy_tokens(s):
+    """Return the folded form of s, its word set and its words sorted, cached across calls."""
+    folded = fold_string(s)
+    parts = frozenset(folded.split())
+    return folded, parts, ' '.join(sorted(parts))
+
+def number_tokens(parts):
+    """The words of a folded string that number it: digits, roman numerals and number words."""
+    return frozenset(p for p in parts if any(c.isdigit() for c in p) or p in NUMBER_WORDS or ROMAN_NUMERAL_RE.match(p))
+
+def tokens_align(parts, result_parts, threshold=0.8):
+    """
+    True when two word sets differ only by misspellings: every word missing from the other
+    side has a close (similarity >= threshold) counterpart there, and no numbering word differs.
+    """
+    if number_tokens(parts) != number_tokens(result_parts):
         return False
+    only, result_only = parts - result_parts, result_parts - parts
+    return (all(any(similarity(p, r) >= threshold for r in result_only) for p in only)
+            and all(any(similarity(p, r) >= threshold for p in only) for r in result_only))
+
+def similarity(a, b):
+    """Character-level similarity of two strings between 0 and 1."""
+    if not a or not b:
+        return 0.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+def token_set_ratio(parts, result_parts):
+    """Similarity of two word sets that ignores order and extra words on either side."""
+    common = ' '.join(sorted(parts & result_parts))
+    with_rest = (common + ' ' + ' '.join(sorted(parts - result_parts))).strip()
+    result_with_rest = (common + ' ' + ' '.join(sorted(result_parts - parts))).strip()
+    return max(similarity(common, with_rest), similarity(common, result_with_rest), similarity(with_rest, result_with_rest))
+
+class FuzzyMatcher(TrackMatcher):
+    """
+    Unicode-aware matcher: folds accents and scripts, ignores edition suffixes and
+    scores names by similarity instead of exact word overlap. Similarity only makes up
+    for misspellings: names whose numbering differs ("Part 1"/"Part 2", sequels) never
+    match, and artists must be the same once folded.
+    """
+    TRACK_THRESHOLD = 0.9
+    ALBUM_THRESHOLD = 0.6
+
+    def __init__(self, artist, album, track):
+        self.artist = self.fold_artist(artist)
+        self.album, self.album_parts, _ = fuzzy_tokens(album)
+        _, self.track_parts, self.track_sorted = fuzzy_tokens(track)
+
+    @staticmethod
+    def fold_artist(artist):
+        """Folded artist name without a leading "The", with & and + read as "and" and spacing ignored."""
+        artist = AMPERSAND_RE.sub(' and ', LEADING_ARTICLE_RE.sub('', artist.strip().lower()))
+        return fuzzy_tokens(artist)[0].replace(' ', '')
+
+    def artist_matches(self, result_artist):
+        return bool(self.artist) and self.fold_artist(result_artist) == self.artist
+
+    def album_ratio(self, result_album_parts):
+        """Similarity of a result's album to the target's, 0 when their numbering differs."""
+        if number_tokens(self.album_parts) != number_tokens(result_album_parts):
+            return 0.0
+        return token_set_ratio(self.album_parts, result_album_parts)
+
+    def score(self, result, check_album=True):
+        """
+        Return (track_ratio, album_ratio) for a search result, or None if it doesn't match.
+        check_album: if False, skip album verification
+        """
+        if not self.artist_matches(result['artists'][0]['name']):
+            return None
         
-    # For album, check if one contains the other after normalization
-    if check_album:
-        result_album = result['album']['name']
-        norm_result_album = normalize_string(result_album)
-        norm_album = normalize_string(album)
+        # Accept the usual word overlap, or near-identical titles that only differ by misspellings
+        _, result_track_parts, result_track_sorted = fuzzy_tokens(result['name'])
+        if number_tokens(self.track_parts) != number_tokens(result_track_parts):
+            return None
+        overlap = word_match_ratio(self.track_parts, result_track_parts)
+        track_ratio = overlap
+        if overlap < TrackMatcher.TRACK_THRESHOLD:
+            if not tokens_align(self.track_parts, result_track_parts):
+                return None
+            track_ratio = similarity(self.track_sorted, result_track_sorted)
+            if track_ratio < self.TRACK_THRESHOLD:
+                return None
         
-        if norm_result_album and norm_album:
-            album_parts = set(norm_album.split())
-            result_album_parts = set(norm_result_album.split())
-            common_album_words = album_parts.intersection(result_album_parts)
-            album_match_ratio = len(common_album_words) / max(len(album_parts), len(result_album_parts))
-            
-            # Lower threshold for album matching (0.5 or 50% of words should match)
-            if album_match_ratio < 0.5:
-                return False
-    
-    return True
+        album_ratio = 1.0
+        if check_album:
+            result_album, result_album_parts, _ = fuzzy_tokens(result['album']['name'])
+            if result_album and self.album:
+                album_ratio = self.album_ratio(result_album_parts)
+                if album_ratio < self.ALBUM_THRESHOLD:
+                    return None
+        
+        return track_ratio, album_ratio
+
+    def matches_album(self, result):
+        result_album_parts = fuzzy_tokens(result['name'])[1]
+        if not self.artist_matches(result['artists'][0]['name']) or not self.album_parts or not result_album_parts:
+            return False
+        return self.album_ratio(result_album_parts) >= self.ALBUM_THRESHOLD
+
+# Matching engines selectable with MATCH_ENGINE
+MATCH_ENGINES = {
+    'token': TrackMatcher,
+    'fuzzy': FuzzyMatcher,
+}
+
+def make_matcher(artist, album, track):
+    """Create a matcher for one target track using the configured engine."""
+    return MATCH_ENGINES.get(MATCH_ENGINE, FuzzyMatcher)(artist, album, track)
+
+def is_match(result, artist, album, track, check_album=True):
+    """
+    Check if a search result matches the target track.
+    check_album: if False, skip album verification
+    """
+    return make_matcher(artist, album, track).matches(result, check_album)
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+class ResponseCache:
+    """
+    SQLite-backed cache of API responses shared across runs and worker threads.
+    Entries are keyed by source and normalized request, expire after a per-source
+    TTL (shorter for misses) and are evicted least-recently-used past max_entries.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def _connect(self):
+        # SQLite connections can't be shared across processes, open one per process
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses (source TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (source, key))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON responses (last_used)')
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash request parts into a cache key."""
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, source, key):
+        """Return (found, value) for a cached response."""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute('SELECT value, expires_at FROM responses WHERE source = ? AND key = ?', (source, key)).fetchone()
+            if row and row[1] > now:
+                conn.execute('UPDATE responses SET last_used = ? WHERE source = ? AND key = ?', (now, source, key))
+                conn.commit()
+                metrics.count('cache_hits', source)
+                return True, json.loads(row[0])
+            metrics.count('cache_misses', source)
+            return False, None
+
+    def set(self, source, key, value, miss=False):
+        """Store a response; misses are kept for the source's shorter negative TTL."""
+        now = time.time()
+        ttl_hit, ttl_miss = RESPONSE_CACHE_TTLS.get(source, (86400, 86400))
+        expires_at = now + (ttl_miss if miss else ttl_hit)
+        with self.lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO responses(source, key, value, expires_at, last_used) VALUES(?, ?, ?, ?, ?)',
+                         (source, key, json.dumps(value), expires_at, now))
+            conn.commit()
+            self.writes += 1
+            if self.writes % 500 == 0:
+                self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM responses WHERE expires_at <= ?', (now,))
+        count = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self.max_entries:
+            conn.execute('DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY last_used ASC LIMIT ?)',
+                         (count - self.max_entries,))
+        conn.commit()
+
+    def cached(self, source, key_parts, fetch, is_miss=lambda value: value is None):
+        """
+        Return the cached response for key_parts, calling fetch() on a cache miss.
+        Exceptions from fetch() propagate and are not cached.
+        """
+        key = self.make_key(source, *key_parts)
+        found, value = self.get(source, key)
+        if found:
+            return value
+        value = fetch()
+        self.set(source, key, value, miss=is_miss(value))
+        return value
+
+    def forget(self, source, key_parts):
+        """Drop the cached response for key_parts so the next request fetches it again."""
+        key = self.make_key(source, *key_parts)
+        with self.lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM responses WHERE source = ? AND key = ?', (source, key))
+            conn.commit()
+
+def normalize_query(s):
+    """Normalize free-text query parts so equivalent requests share a cache entry."""
+    return ' '.join(str(s).lower().split())
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES)
+
+# =============================================================================
+# HTTP CLIENT
+# =============================================================================
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+def host_key(hostname):
+    """The HTTP_HOST_RATES entry covering hostname, or its last two labels for other hosts."""
+    for host in HTTP_HOST_RATES:
+        if hostname == host or hostname.endswith('.' + host):
+            return host
+    return '.'.join(hostname.split('.')[-2:])
+
+def backoff_delay(attempt):
+    """Jittered exponential backoff before retry number attempt + 1."""
+    return min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+
+def retry_after_seconds(response):
+    """Seconds the server asked us to wait in its Retry-After header, or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class HostLimiter:
+    """
+    Pacing for one API host. The request rate is halved on every 429 and creeps back up
+    to its configured maximum as requests succeed; a Retry-After pauses the whole host.
+    After HTTP_CIRCUIT_FAILURES consecutive 5xx or connection failures the circuit opens
+    and requests fail fast for HTTP_CIRCUIT_COOLDOWN seconds; the first request after that
+    is a trial that closes it on success or reopens it on failure.
+    """
+
+    def __init__(self, host, rate):
+        self.host = host
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 16
+        self.bucket = TokenBucket(rate)
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def acquire(self):
+        """Fail fast while the circuit is open, otherwise wait out any pause and take a token."""
+        with self.lock:
+            now = time.monotonic()
+            if self.open_until > now:
+                raise CircuitOpenError(f'{self.host} skipped for {self.open_until - now:.0f}s after {self.failures} failed requests')
+            pause = self.paused_until - now
+        if pause > 0:
+            time.sleep(pause)
+        self.bucket.acquire()
+
+    def throttled(self, delay):
+        """Record a 429: halve the rate and hold every request to this host for delay seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.bucket.set_rate(max(self.min_rate, self.bucket.rate / 2))
+
+    def succeeded(self):
+        """Record a completed request, closing the circuit and raising the rate a step."""
+        with self.lock:
+            self.failures = 0
+            if self.bucket.rate < self.max_rate:
+                self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.max_rate / 20))
+
+    def failed(self):
+        """Record a 5xx or connection failure, opening the circuit once there are enough in a row."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= HTTP_CIRCUIT_FAILURES:
+                self.open_until = time.monotonic() + HTTP_CIRCUIT_COOLDOWN
+                print(f"{self.host}: {self.failures} failed requests in a row, pausing calls for {HTTP_CIRCUIT_COOLDOWN:.0f}s")
+
+class RateLimitedSession(requests.Session):
+    """
+    Session used for every outbound API call. Requests are paced per host and get default
+    connect/read timeouts. 429s are retried after the server's Retry-After (or a backoff);
+    5xx and connection errors are retried with jittered exponential backoff, but only for
+    idempotent methods so a POST is never sent twice. After HTTP_MAX_RETRIES the last
+    response is returned unchanged, so callers still decide what an error status means.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+    def __init__(self, pool_size):
+        super().__init__()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+
+    def limiter(self, url):
+        """The HostLimiter shared by every request to url's host."""
+        host = host_key(urllib.parse.urlsplit(url).hostname or '')
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(host, HTTP_HOST_RATES.get(host, HTTP_DEFAULT_RATE_LIMIT))
+            return self.limiters[host]
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        limiter = self.limiter(url)
+        retry_failures = method.upper() in self.IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            limiter.acquire()
+            metrics.count('api_calls', limiter.host)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                limiter.failed()
+                if not retry_failures or attempt >= HTTP_MAX_RETRIES:
+                    raise
+                reason, delay = type(e).__name__, backoff_delay(attempt)
+            else:
+                if response.status_code not in self.RETRY_STATUSES:
+                    limiter.succeeded()
+                    return response
+                if response.status_code == 429:
+                    retry_after = retry_after_seconds(response)
+                    delay = backoff_delay(attempt) if retry_after is None else retry_after
+                    limiter.throttled(min(delay, HTTP_BACKOFF_MAX))
+                    if attempt >= HTTP_MAX_RETRIES or delay > HTTP_BACKOFF_MAX:
+                        return response
+                    # acquire() waits out the pause set by throttled()
+                    delay = 0
+                else:
+                    limiter.failed()
+                    if not retry_failures or attempt >= HTTP_MAX_RETRIES:
+                        return response
+                    delay = backoff_delay(attempt)
+                reason = f'HTTP {response.status_code}'
+                response.close()
+            attempt += 1
+            metrics.count('retries', limiter.host)
+            print(f"{limiter.host}: {reason}, retrying ({attempt}/{HTTP_MAX_RETRIES})")
+            if delay:
+                time.sleep(delay)
+
+# Shared by Spotify, Last.fm, Odesli and Bandcamp calls from every worker thread
+http = RateLimitedSession(max(PIPELINE_WORKERS * LASTFM_FETCH_WORKERS, ODESLI_WORKERS))
 
 # =============================================================================
 # SPOTIFY CONNECTION
@@ -176,20 +1214,106 @@ os.environ["SPOTIPY_CLIENT_SECRET"] = SPOTIFY_CLIENT_SECRET
 os.environ["SPOTIPY_REDIRECT_URI"] = SPOTIFY_REDIRECT_URI
 
 # Create Spotify client for metadata queries (no auth)
-sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(requests_session=http),
+                     requests_session=http, requests_timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
 
 # Create authenticated Spotify client for playlist management
 auth_scope = 'playlist-modify-public playlist-modify-private'
-sp_auth = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=auth_scope, open_browser=False))
+sp_auth = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=auth_scope, open_browser=False, requests_session=http),
+                          requests_session=http, requests_timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+# =============================================================================
+# LAST.FM CONNECTION
+# =============================================================================
+
+def lastfm_request(params):
+    """Make a Last.fm API call through the shared rate-limited session and return the decoded JSON."""
+    query = dict(params, api_key=LASTFM_API_KEY, format='json')
+    response = http.get(LASTFM_API_URL, params=query)
+    response.raise_for_status()
+    return response.json()
+
+def parse_recent_tracks(page_data, author_id):
+    """Convert one page of user.getrecenttracks into last_fm_data rows."""
+    rows = []
+    for track_info in page_data["recenttracks"]["track"]:
+        try:
+            # Skip currently playing tracks (no date)
+            if "@attr" in track_info and track_info["@attr"].get("nowplaying") == "true":
+                continue
+            
+            artist = track_info["artist"]["#text"]
+            album = track_info["album"]["#text"]
+            track = track_info["name"]
+            date_uts = track_info["date"]["uts"]
+            
+            # Convert timestamp to datetime
+            insert_date = datetime.fromtimestamp(int(date_uts)).strftime('%Y-%m-%d %H:%M:%S')
+            
+            rows.append((artist, album, track, insert_date, author_id))
+        except Exception as e:
+            print(f"Error processing track: {e}")
+    return rows
+
+def fetch_recent_tracks(lastfm_id, author_id, from_ts, to_ts=None):
+    """
+    Fetch all pages of a user's recent tracks between from_ts and to_ts concurrently.
+    Returns (rows, num_pages, total_tracks, max_uts); rows are in Last.fm page order.
+    Pass a to_ts: without one a scrobble arriving mid-fetch shifts every page by a row.
+    A row that still turns up on two pages is only returned once.
+    """
+    params = {'method': 'user.getrecenttracks', 'user': lastfm_id, 'limit': 100, 'from': from_ts}
+    if to_ts is not None:
+        params['to'] = to_ts
+    
+    first_page = lastfm_request(dict(params, page=1))
+    num_pages = int(first_page["recenttracks"]["@attr"]["totalPages"])
+    total_tracks = int(first_page["recenttracks"]["@attr"]["total"])
+    print(f"Found {total_tracks} tracks across {num_pages} pages")
+    
+    pages = {1: first_page}
+    if num_pages > 1:
+        with ThreadPoolExecutor(max_workers=LASTFM_FETCH_WORKERS) as pool:
+            futures = {pool.submit(metrics.bind(lastfm_request), dict(params, page=page)): page for page in range(2, num_pages + 1)}
+            try:
+                for future in as_completed(futures):
+                    pages[futures[future]] = future.result()
+                    print(f"Fetched page {futures[future]} of {num_pages}")
+            except Exception:
+                # One failed page invalidates the whole fetch, don't keep hammering the API
+                for future in futures:
+                    future.cancel()
+                raise
+    
+    rows = []
+    max_uts = None
+    for page in sorted(pages):
+        rows.extend(parse_recent_tracks(pages[page], author_id))
+        for track_info in pages[page]["recenttracks"]["track"]:
+            if "date" in track_info:
+                uts = int(track_info["date"]["uts"])
+                max_uts = uts if max_uts is None else max(max_uts, uts)
+    return list(unique(rows)), num_pages, total_tracks, max_uts
 
 # =============================================================================
 # DATA GATHERING FUNCTIONS
 # =============================================================================
 
-def update_lastfm_data(author_id, lastfm_id, period, release_year, keep_updated, years_ago, play_year, playlist_id, populated):
+def local_epoch(ts):
+    """Convert a naive local timestamp (datetime or MySQL string) to a Unix epoch."""
+    if isinstance(ts, str):
+        ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')
+    phoenix = timezone('America/Phoenix')
+    return int(phoenix.localize(ts).timestamp())
+
+def get_sync_cursor(db, author_id):
+    """Return the newest Last.fm scrobble timestamp already synced for a user, or None."""
+    db.execute("SELECT last_uts FROM music_inventory.last_fm_sync_cursor WHERE user = %s", (author_id,))
+    row = db.fetchone()
+    return int(row[0]) if row else None
+
+def update_lastfm_data(db, author_id, lastfm_id, period, release_year, keep_updated, years_ago, play_year, playlist_id, populated):
     """Update user's listening data from Last.fm."""
-    global dtdb, curdt
-    
     start_time = time.time()
     run_now = 'no'
     
@@ -217,141 +1341,374 @@ def update_lastfm_data(author_id, lastfm_id, period, release_year, keep_updated,
         if run_now == 'yes':
             print(f"Running update for user {author_id} (Last.fm: {lastfm_id})")
             
-            # Delete old data for the time period
-            sql = f"DELETE FROM music_inventory.last_fm_data WHERE date_time BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {days_ago} DAY) AND DATE('{start_str}') AND user='{author_id}'"
-            curdt.execute(sql)
+            # Incremental sync only applies to playlists covering the present
+            cursor_uts = None
+            if LASTFM_SYNC_MODE == 'incremental' and years_ago == '0':
+                cursor_uts = get_sync_cursor(db, author_id)
             
-            # Get most recent track timestamp
-            sql = f"SELECT MAX(date_time) AS last_update FROM music_inventory.last_fm_data WHERE user={author_id} AND DATE(date_time) < DATE('{start_str}')"
-            curdt.execute(sql)
-            data = curdt.fetchall()
-            
-            last_update_pre = data[0][0] if data[0][0] else (datetime.now() - timedelta(days=day_length)).strftime('%Y-%m-%d %H:%M:%S')
-            phoenix = timezone('America/Phoenix')
-            naive_ts = datetime.strptime(last_update_pre, '%Y-%m-%d %H:%M:%S')
-            local_ts = phoenix.localize(naive_ts)
-            epoch_ts = local_ts.timestamp()
-            epoch_ts_i = int(epoch_ts)
+            if cursor_uts is not None:
+                # Only ask for scrobbles newer than the cursor and append them
+                print(f"Incremental sync from cursor {cursor_uts}")
+                from_ts = cursor_uts + 1
+                # Fix the window's end now so scrobbles made during the fetch can't shift the pages
+                to_ts = int(time.time())
+                last_update_pre = datetime.fromtimestamp(from_ts).strftime('%Y-%m-%d %H:%M:%S')
+            else:
+                # Historical windows stop at the window end so rows after it aren't duplicated,
+                # current ones at the time of the request
+                to_ts = local_epoch(start.replace(hour=23, minute=59, second=59, microsecond=0)) if years_ago != '0' else int(time.time())
+                to_str = datetime.fromtimestamp(to_ts).strftime('%Y-%m-%d %H:%M:%S')
+                
+                # Delete the stored data for the time period, up to where the fetch will end,
+                # so every scrobble it returns replaces one deleted here
+                sql = f"DELETE FROM music_inventory.last_fm_data WHERE date_time >= DATE_SUB(DATE('{start_str}'), INTERVAL {days_ago} DAY) AND date_time <= '{to_str}' AND user='{author_id}'"
+                db.execute(sql)
+                # Same hours in the rollup; the re-inserted scrobbles get rolled up again
+                sql = f"DELETE FROM music_inventory.listening_rollup WHERE play_date >= DATE_SUB(DATE('{start_str}'), INTERVAL {days_ago} DAY) AND TIMESTAMP(play_date) + INTERVAL play_hour HOUR <= '{to_str}' AND user='{author_id}'"
+                db.execute(sql)
+                
+                # Get most recent track timestamp
+                sql = f"SELECT MAX(date_time) AS last_update FROM music_inventory.last_fm_data WHERE user='{author_id}' AND date_time < DATE('{start_str}')"
+                db.execute(sql)
+                data = db.fetchall()
+                
+                if data[0][0]:
+                    # That scrobble is kept, so start just after it
+                    last_update_pre = data[0][0]
+                    from_ts = local_epoch(last_update_pre) + 1
+                else:
+                    last_update_pre = (datetime.now() - timedelta(days=day_length)).strftime('%Y-%m-%d %H:%M:%S')
+                    from_ts = local_epoch(last_update_pre)
             
             # Fetch data from Last.fm
             try:
-                response = requests.get(f'https://ws.audioscrobbler.com/2.0//?method=user.getrecenttracks&user={lastfm_id}&api_key={LASTFM_API_KEY}&from={epoch_ts_i}&format=json&limit=100&period=overall&page=1')
-                response.raise_for_status()
-                json_response = response.json()
-                
-                num_pages = int(json_response["recenttracks"]["@attr"]["totalPages"])
-                total_tracks = int(json_response["recenttracks"]["@attr"]["total"])
-                print(f"Found {total_tracks} tracks across {num_pages} pages")
-                
-                all_tracks = []
-                for page in range(1, min(num_pages + 1, 50)):  # Limit to 50 pages to avoid very long runs
-                    print(f"Fetching page {page} of {num_pages}")
-                    
-                    retries = 0
-                    while retries < 3:
-                        try:
-                            page_response = requests.get(f'https://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks&user={lastfm_id}&api_key={LASTFM_API_KEY}&format=json&limit=100&period=overall&page={page}')
-                            page_response.raise_for_status()
-                            page_data = page_response.json()
-                            
-                            # Process tracks on this page
-                            for track_idx in range(len(page_data["recenttracks"]["track"])):
-                                try:
-                                    track_info = page_data["recenttracks"]["track"][track_idx]
-                                    
-                                    # Skip currently playing tracks (no date)
-                                    if "@attr" in track_info and track_info["@attr"].get("nowplaying") == "true":
-                                        continue
-                                    
-                                    artist = track_info["artist"]["#text"]
-                                    album = track_info["album"]["#text"]
-                                    track = track_info["name"]
-                                    date_uts = track_info["date"]["uts"]        
-                                    
-                                    # Convert timestamp to datetime
-                                    insert_date = datetime.fromtimestamp(int(date_uts)).strftime('%Y-%m-%d %H:%M:%S')
-                                    
-                                    all_tracks.append((artist, album, track, insert_date, author_id))
-                                except Exception as e:
-                                    print(f"Error processing track: {e}")
-                            
-                            break  # Exit retry loop on success
-                        except HTTPError as e:
-                            print(f"HTTP Error: {e}, retrying ({retries+1}/3)")
-                            retries += 1
-                            time.sleep(3)
-                    
-                    # Respect Last.fm API rate limits
-                    time.sleep(0.5)
+                all_tracks, num_pages, total_tracks, max_uts = fetch_recent_tracks(lastfm_id, author_id, from_ts, to_ts)
                 
                 # Batch insert all tracks
                 if all_tracks:
                     print(f"Inserting {len(all_tracks)} tracks into database")
-                    curdt.executemany('INSERT INTO last_fm_data(artist, album, track, date_time, user) VALUES(%s, %s, %s, %s, %s)', all_tracks)
-                    dtdb.commit()
+                    db.executemany('INSERT INTO last_fm_data(artist, album, track, date_time, user) VALUES(%s, %s, %s, %s, %s)', all_tracks)
+                    metrics.rows(len(all_tracks))
+                    
+                    # Advance the cursor in the same transaction as the rows it covers
+                    if years_ago == '0' and max_uts is not None:
+                        sql = "INSERT INTO music_inventory.last_fm_sync_cursor(user, last_uts) VALUES(%s, %s) ON DUPLICATE KEY UPDATE last_uts = GREATEST(last_uts, VALUES(last_uts))"
+                        db.execute(sql, (author_id, min(max_uts, to_ts)))
+                    db.commit()
                     
                     # Update stats
-                    run_stats = [last_update_pre, epoch_ts_i, num_pages, len(all_tracks)]
-                    curdt.execute('INSERT INTO last_fm_data_update(update_from, update_epoch, num_pages, num_tracks) VALUES(%s, %s, %s, %s)', run_stats)
-                    dtdb.commit()
+                    run_stats = [last_update_pre, from_ts, num_pages, len(all_tracks)]
+                    db.execute('INSERT INTO last_fm_data_update(update_from, update_epoch, num_pages, num_tracks) VALUES(%s, %s, %s, %s)', run_stats)
+                    db.commit()
                     
                     # Mark playlist as populated
                     populated_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    curdt.execute('UPDATE music_inventory.users_playlists SET populated=%s WHERE playlist_id = %s', (populated_time, playlist_id))
-                    dtdb.commit()
+                    db.execute('UPDATE music_inventory.users_playlists SET populated=%s WHERE playlist_id = %s', (populated_time, playlist_id))
+                    db.commit()
                     
                     print(f"Last.fm data update complete for user {author_id}")
                 else:
+                    # Commit the window delete even when there was nothing to re-insert
+                    db.commit()
                     print(f"No tracks found for user {author_id}")
                 
             except Exception as e:
+                db.rollback()
                 row_err = lineno()
                 message = f"Error fetching Last.fm data: {e}"
-                log_error(message, row_err)
+                log_error(db, message, row_err)
                 print(f"Error: {message}")
     except Exception as e:
         row_err = lineno()
         message = f"Error in update_lastfm_data: {e}"
-        log_error(message, row_err)
+        log_error(db, message, row_err)
         print(f"Error: {message}")
     
     print(f"Time elapsed: {time.time() - start_time:.2f} seconds")
 
-def create_album():
-    """Create album entries for any albums in last_fm_data without entries."""
-    global dtdb, curdt
-    
-    sql = "SELECT d.artist, d.album FROM music_inventory.last_fm_data d LEFT JOIN last_fm_album_meta a ON d.artist = a.artist AND d.album = a.album WHERE a.id IS NULL GROUP BY d.artist, d.album"
-    curdt.execute(sql)
-    data = curdt.fetchall()
+def get_watermark(db, stage):
+    """Return the last last_fm_data.id a pipeline stage has processed (0 if never run)."""
+    db.execute("SELECT last_id FROM music_inventory.pipeline_watermark WHERE stage = %s", (stage,))
+    row = db.fetchone()
+    return int(row[0]) if row else 0
 
-    if data:
-        curdt.executemany("INSERT INTO music_inventory.last_fm_album_meta(artist,album) VALUES (%s,%s)", data)
-        dtdb.commit()
-        print(f"Added {len(data)} new album entries")
+def set_watermark(db, stage, last_id):
+    """Record the last last_fm_data.id a stage has processed; committed by the caller."""
+    sql = "INSERT INTO music_inventory.pipeline_watermark(stage, last_id) VALUES(%s, %s) ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)"
+    db.execute(sql, (stage, last_id))
 
-def create_track():
-    """Create track entries for any tracks in last_fm_data without entries."""
-    global dtdb, curdt
+def upsert_new_scrobble_keys(db, stage, table, columns):
+    """
+    Insert the distinct `columns` values of scrobbles ingested since the stage's
+    watermark into `table`, skipping ones that already exist.
+    Works through last_fm_data in id windows, committing the watermark with each window.
+    """
+    last_id = get_watermark(db, stage)
+    db.execute("SELECT MAX(id) FROM music_inventory.last_fm_data")
+    max_id = db.fetchone()[0] or 0
+    
+    column_list = ', '.join(columns)
+    placeholders = ', '.join(['%s'] * len(columns))
+    added = 0
+    while last_id < max_id:
+        upper = min(last_id + WATERMARK_SCAN_ROWS, max_id)
+        sql = f"SELECT DISTINCT {column_list} FROM music_inventory.last_fm_data WHERE id > %s AND id <= %s"
+        db.execute(sql, (last_id, upper))
+        data = db.fetchall()
+        metrics.rows(len(data))
+        
+        for chunk in chunked(data, BULK_INSERT_CHUNK):
+            db.executemany(f"INSERT IGNORE INTO music_inventory.{table}({column_list}) VALUES ({placeholders})", chunk)
+            added += db.rowcount
+        set_watermark(db, stage, upper)
+        db.commit()
+        last_id = upper
+    
+    return added
+
+def create_album(db):
+    """Create album entries for albums in scrobbles ingested since the last run."""
+    added = upsert_new_scrobble_keys(db, 'create_album', 'last_fm_album_meta', ('artist', 'album'))
+    if added:
+        print(f"Added {added} new album entries")
+
+def create_track(db):
+    """Create track entries for tracks in scrobbles ingested since the last run."""
+    added = upsert_new_scrobble_keys(db, 'create_track', 'last_fm_track_meta', ('artist', 'album', 'track'))
+    if added:
+        print(f"Added {added} new track entries")
+
+def link_scrobble_keys(db, backfill=False):
+    """
+    Point scrobbles at their track/album meta rows by integer id, and tracks at their album.
+    Normally only scrobbles past the link_keys watermark are touched; backfill=True walks
+    the whole table and fills any row still missing its ids.
+    """
+    # Tracks reference their album
+    sql = """
+    UPDATE music_inventory.last_fm_track_meta t 
+    INNER JOIN music_inventory.last_fm_album_meta a ON t.artist = a.artist AND t.album = a.album 
+    SET t.album_meta_id = a.id 
+    WHERE t.album_meta_id IS NULL
+    """
+    db.execute(sql)
+    db.commit()
+    
+    last_id = 0 if backfill else get_watermark(db, 'link_keys')
+    db.execute("SELECT MAX(id) FROM music_inventory.last_fm_data")
+    max_id = db.fetchone()[0] or 0
+    
+    linked = 0
+    while last_id < max_id:
+        upper = min(last_id + WATERMARK_SCAN_ROWS, max_id)
+        sql = """
+        UPDATE music_inventory.last_fm_data d 
+        INNER JOIN music_inventory.last_fm_track_meta t ON d.artist = t.artist AND d.album = t.album AND d.track = t.track 
+        SET d.track_meta_id = t.id, d.album_meta_id = t.album_meta_id 
+        WHERE d.id > %s AND d.id <= %s AND (d.track_meta_id IS NULL OR d.album_meta_id IS NULL)
+        """
+        db.execute(sql, (last_id, upper))
+        linked += db.rowcount
+        set_watermark(db, 'link_keys', upper)
+        db.commit()
+        last_id = upper
+        if backfill:
+            print(f"Backfilled scrobble keys through id {upper} of {max_id}")
+    
+    if linked:
+        print(f"Linked {linked} scrobbles to track and album ids")
+
+# A play of track t whose duration enrichment can still find. Tracks without an album are
+# never enriched and count as 0 ms, as they always have
+UNPRICED_PLAY_SQL = "COALESCE(t.duration_ms, 0) <= 0 AND t.album != ''"
+# Listening time of a play of track t, counting unpriced plays as UNKNOWN_DURATION_MS
+PLAY_DURATION_SQL = f"IF({UNPRICED_PLAY_SQL}, {UNKNOWN_DURATION_MS}, t.duration_ms)"
+
+def update_listening_rollup(db, rebuild=False):
+    """
+    Add scrobbles ingested since the last run to listening_rollup, the per user/day/hour/album
+    play counts and listening time that playlist ranking reads.
+    Runs before enrichment, so plays of tracks without a duration yet are counted in
+    unpriced_plays instead; reprice_listening_rollup prices them once durations are known.
+    rebuild=True clears the rollup and recomputes it from all of last_fm_data.
+    """
+    if rebuild:
+        db.execute("DELETE FROM music_inventory.listening_rollup")
+        db.execute("UPDATE music_inventory.last_fm_track_meta SET rollup_duration_ms = duration_ms WHERE duration_changed = 1")
+        set_watermark(db, 'listening_rollup', 0)
+        db.commit()
+    
+    last_id = get_watermark(db, 'listening_rollup')
+    db.execute("SELECT MAX(id) FROM music_inventory.last_fm_data")
+    max_id = db.fetchone()[0] or 0
+    
+    while last_id < max_id:
+        upper = min(last_id + WATERMARK_SCAN_ROWS, max_id)
+        sql = f"""
+        INSERT INTO music_inventory.listening_rollup(user, play_date, play_hour, album_meta_id, plays, unpriced_plays, duration_ms) 
+        SELECT d.user, DATE(d.date_time), HOUR(d.date_time), d.album_meta_id, COUNT(*), 
+               COALESCE(SUM({UNPRICED_PLAY_SQL}), 0), COALESCE(SUM(GREATEST(t.duration_ms, 0)), 0) 
+        FROM music_inventory.last_fm_data d 
+        LEFT JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+        WHERE d.id > %s AND d.id <= %s AND d.album_meta_id IS NOT NULL 
+        GROUP BY d.user, DATE(d.date_time), HOUR(d.date_time), d.album_meta_id 
+        ON DUPLICATE KEY UPDATE plays = plays + VALUES(plays), unpriced_plays = unpriced_plays + VALUES(unpriced_plays), 
+                                duration_ms = duration_ms + VALUES(duration_ms)
+        """
+        db.execute(sql, (last_id, upper))
+        set_watermark(db, 'listening_rollup', upper)
+        db.commit()
+        last_id = upper
+        if rebuild:
+            print(f"Rolled up scrobbles through id {upper} of {max_id}")
+
+def reprice_listening_rollup(db):
+    """
+    Recompute the rollup hours that hold plays of tracks whose duration_ms changed since the
+    rollup last counted them (rollup_duration_ms): unpriced tracks enrichment has found a
+    duration for, and imputed durations later replaced by a real one.
+    """
+    last_id = get_watermark(db, 'listening_rollup')
+    db.execute("DROP TEMPORARY TABLE IF EXISTS rollup_reprice_hours")
+    sql = """
+    CREATE TEMPORARY TABLE rollup_reprice_hours (PRIMARY KEY (user, play_date, play_hour, album_meta_id)) 
+    SELECT DISTINCT d.user, DATE(d.date_time) AS play_date, HOUR(d.date_time) AS play_hour, d.album_meta_id 
+    FROM music_inventory.last_fm_track_meta t 
+    INNER JOIN music_inventory.last_fm_data d ON d.track_meta_id = t.id 
+    WHERE t.duration_changed = 1 AND d.id <= %s AND d.album_meta_id IS NOT NULL
+    """
+    db.execute(sql, (last_id,))
+    db.execute("DROP TEMPORARY TABLE IF EXISTS rollup_reprice")
+    sql = f"""
+    CREATE TEMPORARY TABLE rollup_reprice (PRIMARY KEY (user, play_date, play_hour, album_meta_id)) 
+    SELECT h.user, h.play_date, h.play_hour, h.album_meta_id, 
+           COALESCE(SUM({UNPRICED_PLAY_SQL}), 0) AS unpriced_plays, COALESCE(SUM(GREATEST(t.duration_ms, 0)), 0) AS duration_ms 
+    FROM rollup_reprice_hours h 
+    INNER JOIN music_inventory.last_fm_data d ON d.user = h.user AND d.album_meta_id = h.album_meta_id 
+        AND d.date_time >= h.play_date + INTERVAL h.play_hour HOUR 
+        AND d.date_time < h.play_date + INTERVAL h.play_hour + 1 HOUR 
+    LEFT JOIN music_inventory.last_fm_track_meta t ON t.id = d.track_meta_id 
+    WHERE d.id <= %s 
+    GROUP BY h.user, h.play_date, h.play_hour, h.album_meta_id
+    """
+    db.execute(sql, (last_id,))
+    sql = """
+    UPDATE music_inventory.listening_rollup r 
+    INNER JOIN rollup_reprice x ON x.user = r.user AND x.play_date = r.play_date 
+        AND x.play_hour = r.play_hour AND x.album_meta_id = r.album_meta_id 
+    SET r.unpriced_plays = x.unpriced_plays, r.duration_ms = x.duration_ms
+    """
+    db.execute(sql)
+    metrics.rows(db.rowcount)
+    db.execute("UPDATE music_inventory.last_fm_track_meta SET rollup_duration_ms = duration_ms WHERE duration_changed = 1")
+    db.execute("DROP TEMPORARY TABLE rollup_reprice")
+    db.execute("DROP TEMPORARY TABLE rollup_reprice_hours")
+    db.commit()
+
+def save_spotify_match(db, artist, album, track, track_id, album_id, spotify_id_scan, context):
+    """Store a matched Spotify track (and its album) against the Last.fm track and album."""
+    try:
+        # Update scantime and ID if found
+        sql = "UPDATE music_inventory.last_fm_track_meta SET spotify_id=%s, spotify_id_scan=%s, spotify_album_id=%s, spotify_id_attempts=0, spotify_id_next_scan=NULL WHERE artist=%s and album=%s and track=%s"
+        db.uow.execute(sql, (track_id, spotify_id_scan, album_id, artist, album, track))
+        
+        if album_id:
+            try:
+                scantime = whattimeisit()
+                sql = "UPDATE music_inventory.last_fm_album_meta SET spotify_album_id=%s, spotify_update=%s WHERE artist=%s AND album=%s"
+                db.uow.execute(sql, (album_id, scantime, artist, album))
+                row_err = lineno()
+                message = f'Album search successful for: {artist} {track}'
+                print(row_err, message)
+            except Exception as e:
+                row_err = lineno()
+                message = f'Error updating album {album} by {artist}: {str(e)}'
+                log_error(db, message, row_err)
+                print(row_err, message)
+    except Exception as e:
+        message = f'{context}: - Error updating row for {artist}\'s album {album}, track: {track}: {str(e)}'
+        row_err = lineno()
+        print(lineno(), message)
+        log_error(db, message, row_err)
+
+def is_album_match(result, artist, album):
+    """Check if a Spotify album search result matches the target album."""
+    return make_matcher(artist, album, '').matches_album(result)
+
+def spotify_album_lookup(artist, album, spotify_album_id=None):
+    """
+    Find an album on Spotify and return {'id', 'name', 'tracks'} or None.
+    Uses the known Spotify album ID when there is one, otherwise one album search.
+    """
+    if not spotify_album_id:
+        results = response_cache.cached('spotify_album_search', (normalize_query(artist), normalize_query(album)),
+                                        lambda: sp.search(q=f'artist:{artist} album:{album}', type='album', limit=10),
+                                        is_miss=lambda r: not r.get('albums', {}).get('items'))
+        for result in results.get('albums', {}).get('items', []):
+            if is_album_match(result, artist, album):
+                spotify_album_id = result['id']
+                break
+        else:
+            return None
+    
+    def fetch():
+        album_info = sp.album(spotify_album_id)
+        page = album_info['tracks']
+        tracks = list(page['items'])
+        while page['next']:
+            page = sp.next(page)
+            tracks.extend(page['items'])
+        return {'id': album_info['id'], 'name': album_info['name'], 'tracks': tracks}
+    
+    return response_cache.cached('spotify_album', (spotify_album_id,), fetch)
+
+def resolve_album_tracks(db, artist, album, tracks, spotify_album_id=None):
+    """
+    Match several tracks of one album against a single Spotify album listing.
+    Returns the track names that couldn't be matched and still need a search.
+    """
+    try:
+        found_album = spotify_album_lookup(artist, album, spotify_album_id)
+    except Exception as e:
+        print(f"{lineno()} - Album lookup failed for {artist} - {album}: {str(e)}")
+        return list(tracks)
+    
+    if not found_album:
+        print(f"{lineno()} - Album {album} by {artist} not found on Spotify")
+        return list(tracks)
     
-    sql = "SELECT d.artist, d.album, d.track FROM music_inventory.last_fm_data d LEFT JOIN last_fm_track_meta a ON d.artist = a.artist AND d.album = a.album AND d.track = a.track WHERE a.id IS NULL GROUP BY d.artist, d.album, d.track"
-    curdt.execute(sql)
-    data = curdt.fetchall()
+    spotify_id_scan = whattimeisit()
+    album_ref = {'id': found_album['id'], 'name': found_album['name']}
+    leftovers = []
+    candidates = [dict(item, album=album_ref) for item in found_album['tracks']]
+    for track in tracks:
+        item = make_matcher(artist, album, track).best_match(candidates, check_album=True)
+        if item:
+            print(f"Found album match: {item['name']} by {item['artists'][0]['name']} from album {album_ref['name']}")
+            save_spotify_match(db, artist, album, track, item['id'], album_ref['id'], spotify_id_scan, f'Album {album}')
+        else:
+            leftovers.append(track)
+    
+    print(f"{lineno()} - Matched {len(tracks) - len(leftovers)} of {len(tracks)} tracks from album listing for {artist} - {album}")
+    return leftovers
 
-    if data:
-        curdt.executemany("INSERT INTO music_inventory.last_fm_track_meta(artist,album,track) VALUES (%s,%s,%s)", data)
-        dtdb.commit()
-        print(f"Added {len(data)} new track entries")
+# next_scan is assigned before attempts is incremented, so it backs off by base * 2^(previous attempts) days
+SPOTIFY_BACKOFF_SQL = """
+UPDATE music_inventory.last_fm_track_meta 
+SET spotify_id_scan=%s, 
+    spotify_id_next_scan=DATE_ADD(%s, INTERVAL LEAST(%s * POW(2, LEAST(spotify_id_attempts, 16)), %s) DAY), 
+    spotify_id_attempts=spotify_id_attempts + 1 
+WHERE artist=%s and album=%s and track=%s
+"""
 
-def search_spotify(artist, album, track, i, rc, strict=True):
+def search_spotify(db, artist, album, track, i, rc=None, strict=True):
     """
     Search Spotify with different levels of strictness.
     strict: if True, use artist:"" track:"" format and check album
     """
-    global dtdb, curdt
-    
     spotify_id_scan = whattimeisit()
     search_attempted = False  # Flag to track if search was actually attempted
+    row_label = f'Row #{i} of {rc}' if rc else f'Row #{i}'
     
     # Format search string based on strictness
     spotify_search = f'{artist} {track}'
@@ -360,279 +1717,406 @@ def search_spotify(artist, album, track, i, rc, strict=True):
         
     try:
         # Search with increased limit
-        results = sp.search(q=spotify_search, type='track', limit=50)
+        results = response_cache.cached('spotify_search', (normalize_query(spotify_search),),
+                                        lambda: sp.search(q=spotify_search, type='track', limit=50),
+                                        is_miss=lambda r: not r.get('tracks', {}).get('items'))
         search_attempted = True  # Mark that we successfully attempted a search
         
-        # Check each result for a match
-        matched_result = None
-        if 'tracks' in results and 'items' in results['tracks']:
-            for result in results['tracks']['items']:
-                if is_match(result, artist, album, track, check_album=strict):
-                    matched_result = result
-                    print(f"\nFound match: {result['name']} by {result['artists'][0]['name']} from album {result['album']['name']}")
-                    break
+        # Pick the best matching result
+        matcher = make_matcher(artist, album, track)
+        matched_result = matcher.best_match(results.get('tracks', {}).get('items') or [], check_album=strict)
+        if matched_result:
+            print(f"\nFound match: {matched_result['name']} by {matched_result['artists'][0]['name']} from album {matched_result['album']['name']}")
         
         if matched_result:
-            track_id = matched_result['id']
-            album_id = matched_result['album']['id']
-            
-            try:
-                # Update scantime and ID if found
-                sql = "UPDATE music_inventory.last_fm_track_meta SET spotify_id=%s, spotify_id_scan=%s, spotify_album_id=%s WHERE artist=%s and album=%s and track=%s"
-                curdt.execute(sql, (track_id, spotify_id_scan, album_id, artist, album, track))
-                dtdb.commit()
-                
-                if album_id:
-                    try:
-                        scantime = whattimeisit()
-                        sql = "UPDATE music_inventory.last_fm_album_meta SET spotify_album_id=%s, spotify_update=%s WHERE artist=%s AND album=%s"
-                        curdt.execute(sql, (album_id, scantime, artist, album))
-                        dtdb.commit()
-                        row_err = lineno()
-                        message = f'Album search successful for: {spotify_search}'
-                        print(row_err, message)
-                    except Exception as e:
-                        row_err = lineno()
-                        message = f'Error updating album {album} by {artist}: {str(e)}'
-                        log_error(message, row_err)
-                        print(row_err, message)
-            except Exception as e:
-                message = f'Row #{i} of {rc}: - Error updating row for {artist}\'s album {album}, track: {track}: {str(e)}'
-                row_err = lineno()
-                print(lineno(), message)
-                log_error(message, row_err)
-            
+            save_spotify_match(db, artist, album, track, matched_result['id'], matched_result['album']['id'], spotify_id_scan, row_label)
             return True  # Found and processed a match
             
         # Only update scan time if we actually performed a search but found nothing
         if search_attempted:
-            print(f"{lineno()} - Row #{i} of {rc}: No matches found for '{track}' by '{artist}'")
-            sql = "UPDATE music_inventory.last_fm_track_meta SET spotify_id_scan=%s WHERE artist=%s and album=%s and track=%s"
-            curdt.execute(sql, (spotify_id_scan, artist, album, track))
-            dtdb.commit()
+            print(f"{lineno()} - {row_label}: No matches found for '{track}' by '{artist}'")
+            if strict:
+                sql = "UPDATE music_inventory.last_fm_track_meta SET spotify_id_scan=%s WHERE artist=%s and album=%s and track=%s"
+                db.uow.execute(sql, (spotify_id_scan, artist, album, track))
+            else:
+                # Last search for this track failed too: back off exponentially before the next try,
+                # which has to ask Spotify again rather than re-read these results
+                db.uow.execute(SPOTIFY_BACKOFF_SQL, (spotify_id_scan, spotify_id_scan, SPOTIFY_RETRY_BASE_DAYS, SPOTIFY_RETRY_MAX_DAYS,
+                                                     artist, album, track))
+                response_cache.forget('spotify_search', (normalize_query(spotify_search),))
         
         return False  # No match found
             
     except Exception as e:
         row_err = lineno()
-        print(f"{lineno()} - Row #{i} of {rc}: Error attempting Spotify search: {str(e)}")
+        print(f"{lineno()} - {row_label}: Error attempting Spotify search: {str(e)}")
         
         # Don't update spotify_id_scan if the search attempt failed due to an error
         # This ensures we'll try again next time
         
         return False
 
-def get_track_id():
-    """Get Spotify track IDs only for tracks needed in playlists."""
-    global dtdb, curdt
+PENDING_TRACKS_SQL = """
+SELECT t.artist, t.album, t.track, t.id, a.spotify_album_id 
+FROM music_inventory.last_fm_track_meta t 
+LEFT JOIN music_inventory.last_fm_album_meta a ON a.id = t.album_meta_id
+WHERE t.spotify_id IS NULL 
+AND (t.spotify_id_next_scan IS NULL OR t.spotify_id_next_scan <= NOW())
+AND t.album != '' 
+AND EXISTS (SELECT 1 FROM music_inventory.last_fm_data d WHERE d.track_meta_id = t.id {recent}) 
+{albums}{after}
+"""
+
+# The general pass only covers tracks played in the last 60 days; candidate albums are covered
+# whenever they were played, since playlists can look back years
+RECENT_PLAY_SQL = "AND d.date_time > DATE_SUB(NOW(), INTERVAL 60 DAY)"
+
+def album_filter(column, album_ids):
+    """
+    Return an SQL condition and its parameters limiting column to album_ids.
+    None means no limit; an empty list matches nothing.
+    """
+    if album_ids is None:
+        return '', ()
+    if not album_ids:
+        return 'AND FALSE ', ()
+    return f"AND {column} IN ({', '.join(['%s'] * len(album_ids))}) ", tuple(album_ids)
+
+def search_pending_tracks(db, rows, budget):
+    """
+    Resolve streamed (artist, album, track, id, spotify_album_id) rows on Spotify, album by album.
+    budget is the number of tracks that may still be searched (None for no limit);
+    returns what is left of it.
+    """
+    i = 0
+    for (artist, album), album_rows in itertools.groupby(rows, key=lambda row: (row[0], row[1])):
+        album_rows = list(album_rows)
+        pending = [row[2] for row in album_rows]
+        spotify_album_id = album_rows[0][4]
+        tracks = pending
+        
+        # One album listing can resolve many tracks at once; a single track is cheaper to search
+        if len(tracks) >= ALBUM_RESOLVE_MIN_TRACKS or spotify_album_id:
+            tracks = resolve_album_tracks(db, artist, album, tracks, spotify_album_id)
+        i += len(pending) - len(tracks)
+        metrics.rows(len(pending) - len(tracks))
+        
+        for track in tracks:
+            if budget is not None:
+                if budget <= 0:
+                    print(f"{lineno()} - Spotify search budget used up, leaving the rest for the next run")
+                    return 0
+                budget -= 1
+            i += 1
+            metrics.rows(1)
+            
+            # Try to find the track in Spotify
+            track_found = search_spotify(db, artist, album, track, i, strict=True)
+            
+            if not track_found:
+                print("\nNo matches found with strict search, trying relaxed search...")
+                track_found = search_spotify(db, artist, album, track, i, strict=False)
     
+    print(f"{lineno()} - Looked up {i} tracks on Spotify")
+    return budget
+
+def get_track_id(db, candidates, full=True):
+    """
+    Get Spotify track IDs only for tracks needed in playlists. Tracks of the candidate
+    albums are searched first; full=False stops there.
+    """
     # Only search for tracks that:
     # 1. Are in recent listening data (likely to be in playlists)
     # 2. Don't have Spotify IDs yet
-    # 3. Haven't been scanned recently (avoid repeated failures)
-    
-    sql = """
-    SELECT DISTINCT t.id, t.artist, t.album, t.track 
-    FROM music_inventory.last_fm_track_meta t 
-    INNER JOIN music_inventory.last_fm_data d ON t.artist = d.artist AND t.album = d.album AND t.track = d.track
-    WHERE t.spotify_id IS NULL 
-    AND (t.spotify_id_scan IS NULL OR t.spotify_id_scan < DATE_SUB(NOW(), INTERVAL 14 DAY))
-    AND t.album != '' 
-    AND d.date_time > DATE_SUB(NOW(), INTERVAL 60 DAY)
-    GROUP BY t.artist, t.album, t.track
-    ORDER BY MAX(d.date_time) DESC
-    """
-    
-    curdt.execute(sql)
-    data = curdt.fetchall()
-    rc = curdt.rowcount
-    
-    print(f"{lineno()} - Number of tracks to search in Spotify: {rc}")
+    # 3. Are due a retry: misses back off exponentially (see SPOTIFY_BACKOFF_SQL)
+    # Tracks are streamed in (artist, album, track) order so each album's tracks arrive together.
+    budget = SPOTIFY_SEARCH_BUDGET if SPOTIFY_SEARCH_BUDGET > 0 else None
+    
+    # Spend the search budget on albums that could make the next playlists first
+    if candidates:
+        print(f"{lineno()} - Resolving tracks of {len(candidates)} playlist candidate albums first")
+        albums, params = album_filter('t.album_meta_id', candidates)
+        sql = PENDING_TRACKS_SQL.format(recent='', albums=albums, after='{after}')
+        budget = search_pending_tracks(db, iter_keyset(db, sql, 't.artist, t.album, t.track', params), budget)
+    
+    if full:
+        sql = PENDING_TRACKS_SQL.format(recent=RECENT_PLAY_SQL, albums='', after='{after}')
+        search_pending_tracks(db, iter_keyset(db, sql, 't.artist, t.album, t.track'), budget)
+
+def spotify_release_date(results):
+    """Parse a Spotify album release date, padding year/month-only precision."""
+    release_date = results['album']['release_date']
+    if len(release_date) == 4:
+        release_date = release_date + '-10-31'
+    if len(release_date) == 7:
+        release_date = release_date + '-01'
+    return datetime.strptime(release_date, '%Y-%m-%d')
+
+SPOTIFY_META_UPDATE_SQL = """
+UPDATE music_inventory.last_fm_track_meta 
+SET danceability=%s, energy=%s, valence=%s, tempo=%s, popularity=%s, 
+    key_=%s, loudness=%s, mode_=%s, speechiness=%s, instrumentalness=%s, 
+    liveness=%s, duration_ms=%s, scantime=%s, release_date=%s 
+WHERE spotify_id = %s
+"""
+
+SPOTIFY_CLEAR_ID_SQL = "UPDATE music_inventory.last_fm_track_meta SET spotify_id=NULL, spotify_album_id=NULL, spotify_id_scan=%s WHERE spotify_id=%s"
+
+def spotify_meta_row(feature_row, popularity, scantime, release_date, track_id):
+    """Build the SPOTIFY_META_UPDATE_SQL parameters for one track."""
+    return (feature_row['danceability'], feature_row['energy'], feature_row['valence'], feature_row['tempo'], popularity,
+            feature_row['key'], feature_row['loudness'], feature_row['mode'], feature_row['speechiness'], feature_row['instrumentalness'],
+            feature_row['liveness'], int(feature_row['duration_ms']), scantime, release_date, track_id)
+
+def spotify_meta_single(db, track_id):
+    """Fetch metadata for one track; used when a bulk lookup for its batch fails."""
+    scantime = whattimeisit()
     
-    for i, row in enumerate(data, 1):
-        row_id = row[0]
-        artist = row[1]
-        album = row[2]
-        track = row[3]
-        spotify_id_scan = whattimeisit()
+    try:
+        # Get basic track info
+        results = sp.track(track_id)
         
-        # Try to find the track in Spotify
-        track_found = search_spotify(artist, album, track, i, rc, strict=True)
+        try:
+            release_date = spotify_release_date(results)
+            popularity = results['popularity']
+            
+            # Get audio features
+            features = sp.audio_features(tracks=[track_id])
+            for feature_row in features:
+                if feature_row:
+                    db.uow.execute(SPOTIFY_META_UPDATE_SQL, spotify_meta_row(feature_row, popularity, scantime, release_date, track_id))
+            
+        except Exception as e:
+            row_err = lineno()
+            message = f'Error getting track features: {str(e)}'
+            log_error(db, message, row_err)
+            print(row_err, message)
+            
+            # Update scantime even if features failed
+            sql = "UPDATE music_inventory.last_fm_track_meta SET scantime=%s WHERE spotify_id = %s"
+            db.uow.execute(sql, (scantime, track_id))
+            
+    except Exception as e:
+        row_err = lineno()
+        message = f'Track lookup failed for {track_id}: {str(e)}'
+        log_error(db, message, row_err)
+        print(row_err, message)
         
-        if not track_found:
-            print("\nNo matches found with strict search, trying relaxed search...")
-            track_found = search_spotify(artist, album, track, i, rc, strict=False)
+        # Clear the invalid reference, scrobbles still point at this row by id
+        db.uow.execute(SPOTIFY_CLEAR_ID_SQL, (scantime, track_id))
 
-def spotify_meta():
-    """Get additional metadata from Spotify for tracks with IDs but no metadata."""
-    global dtdb, curdt
+def spotify_meta(db, album_ids=None):
+    """Get additional metadata from Spotify for tracks with IDs but no metadata (limited to album_ids if given)."""
+    albums, params = album_filter('t.album_meta_id', album_ids)
+    sql = "SELECT t.id, t.spotify_id FROM music_inventory.last_fm_track_meta t WHERE t.scantime IS NULL AND t.spotify_id IS NOT NULL AND t.album != '' " + albums + "{after}"
     
-    sql = "SELECT t.spotify_id FROM music_inventory.last_fm_track_meta t LEFT JOIN last_fm_data l ON t.album = l.album AND t.artist = l.artist AND t.track = l.track WHERE t.scantime IS NULL AND t.spotify_id IS NOT NULL AND t.album != '' GROUP BY t.track,t.album,t.artist ORDER BY t.artist ASC,t.album ASC"
-    curdt.execute(sql)
-    data = curdt.fetchall()
-    rc = curdt.rowcount
+    # Several tracks can share a Spotify ID, only look each one up once
+    track_ids = unique(row[1] for row in iter_keyset(db, sql, 't.id', params))
     
-    print(f"{lineno()} - Tracks needing Spotify metadata: {rc}")
-    
-    for i, row in enumerate(data, 1):
-        print(f"Processing {i} of {rc}")
+    for i, chunk in enumerate(chunked(track_ids, SPOTIFY_FEATURES_BATCH)):
+        print(f"Processing tracks {i * SPOTIFY_FEATURES_BATCH + 1}-{i * SPOTIFY_FEATURES_BATCH + len(chunk)}")
+        metrics.rows(len(chunk))
         scantime = whattimeisit()
-        track_id = row[0]
         
         try:
-            # Get basic track info
-            results = sp.track(track_id)
+            tracks = []
+            for tracks_chunk in chunked(chunk, SPOTIFY_TRACKS_BATCH):
+                tracks.extend(sp.tracks(tracks_chunk)['tracks'])
+        except Exception as e:
+            # A malformed ID fails the whole request, fall back to one lookup per track
             row_err = lineno()
-            
+            message = f'Bulk track lookup failed, retrying individually: {str(e)}'
+            log_error(db, message, row_err)
+            print(row_err, message)
+            for track_id in chunk:
+                spotify_meta_single(db, track_id)
+            continue
+        
+        try:
+            features = sp.audio_features(tracks=chunk) or []
+        except Exception as e:
+            row_err = lineno()
+            message = f'Error getting track features: {str(e)}'
+            log_error(db, message, row_err)
+            print(row_err, message)
+            features = []
+        features = list(features) + [None] * (len(chunk) - len(features))
+        
+        updates = []
+        scanned = []
+        invalid = []
+        for track_id, results, feature_row in zip(chunk, tracks, features):
+            if not results:
+                invalid.append((scantime, track_id))
+                continue
             try:
-                # Get release date
-                release_date = results['album']['release_date']
-                if len(release_date) == 4:
-                    release_date = release_date + '-10-31'
-                if len(release_date) == 7:
-                    release_date = release_date + '-01'
-                release_date = datetime.strptime(release_date, '%Y-%m-%d')
+                release_date = spotify_release_date(results)
                 popularity = results['popularity']
-                
-                # Get audio features
-                features = sp.audio_features(tracks=[track_id])
-                for feature_row in features:
-                    if feature_row:
-                        danceability = feature_row['danceability']
-                        energy = feature_row['energy']
-                        valence = feature_row['valence']
-                        tempo = feature_row['tempo']
-                        key = feature_row['key']
-                        loudness = feature_row['loudness']
-                        mode = feature_row['mode']
-                        speechiness = feature_row['speechiness']
-                        instrumentalness = feature_row['instrumentalness']
-                        liveness = feature_row['liveness']
-                        duration_ms = int(feature_row['duration_ms'])
-                        
-                        # Update the database with all metadata
-                        sql = """
-                        UPDATE music_inventory.last_fm_track_meta 
-                        SET danceability=%s, energy=%s, valence=%s, tempo=%s, popularity=%s, 
-                            key_=%s, loudness=%s, mode_=%s, speechiness=%s, instrumentalness=%s, 
-                            liveness=%s, duration_ms=%s, scantime=%s, release_date=%s 
-                        WHERE spotify_id = %s
-                        """
-                        curdt.execute(sql, (danceability, energy, valence, tempo, popularity,
-                                           key, loudness, mode, speechiness, instrumentalness,
-                                           liveness, duration_ms, scantime, release_date, track_id))
-                        dtdb.commit()
-                
+                if feature_row:
+                    updates.append(spotify_meta_row(feature_row, popularity, scantime, release_date, track_id))
+                else:
+                    # Update scantime even if features are unavailable
+                    scanned.append((scantime, track_id))
             except Exception as e:
                 row_err = lineno()
                 message = f'Error getting track features: {str(e)}'
-                log_error(message, row_err)
+                log_error(db, message, row_err)
                 print(row_err, message)
-                
-                # Update scantime even if features failed
-                sql = "UPDATE music_inventory.last_fm_track_meta SET scantime=%s WHERE spotify_id = %s"
-                curdt.execute(sql, (scantime, track_id))
-                dtdb.commit()
-                
-        except Exception as e:
-            row_err = lineno()
-            message = f'Track lookup failed for {track_id}: {str(e)}'
-            log_error(message, row_err)
-            print(row_err, message)
-            
-            # Try to delete invalid track reference
-            sql = "SELECT t.artist, t.album, t.track FROM music_inventory.last_fm_track_meta t WHERE t.spotify_id = %s GROUP BY t.track,t.album,t.artist"
-            curdt.execute(sql, [track_id])
-            data = curdt.fetchall()
-            
-            if data:
-                artist = data[0][0]
-                album = data[0][1]
-                track = data[0][2]
-                
-                sql = "DELETE FROM music_inventory.last_fm_track_meta WHERE spotify_id=%s;"
-                curdt.execute(sql, [track_id])
-                dtdb.commit()
+                scanned.append((scantime, track_id))
+        
+        db.uow.executemany(SPOTIFY_META_UPDATE_SQL, updates)
+        db.uow.executemany("UPDATE music_inventory.last_fm_track_meta SET scantime=%s WHERE spotify_id = %s", scanned)
+        if invalid:
+            # Spotify returns null for IDs that no longer exist, clear them so they get searched again
+            print(f"Clearing {len(invalid)} invalid Spotify IDs")
+            db.uow.executemany(SPOTIFY_CLEAR_ID_SQL, invalid)
 
 def bandcamp_url_odesli(spotify_album_id):
-    """Try to find a Bandcamp URL via the Odesli API."""
-    try:
-        bandcamp_url = None
-        bandcamp_update = whattimeisit()
-        
+    """
+    Find an album's Bandcamp URL via the Odesli API. Returns None when Odesli has no
+    Bandcamp link; request errors propagate so the album is retried on the next run.
+    """
+    def fetch():
         # Call Odesli API (formerly song.link) using the API key from environment variables
-        songlink = requests.get(f'https://api.song.link/v1-alpha.1/links?url=spotify%3Aalbum%3A{spotify_album_id}&userCountry=US&key={ODESLI_API_KEY}')
+        songlink = http.get(f'https://api.song.link/v1-alpha.1/links?url=spotify%3Aalbum%3A{spotify_album_id}&userCountry=US&key={ODESLI_API_KEY}')
         songlink.raise_for_status()
         jsonResponse = songlink.json()
         
         try:
-            bandcamp_url = jsonResponse["linksByPlatform"]["bandcamp"]["url"]
+            return jsonResponse["linksByPlatform"]["bandcamp"]["url"]
         except Exception:
-            bandcamp_url = None
-    except Exception:
-        bandcamp_url = None
-        
-    return bandcamp_url, bandcamp_update
-
-def bandcamp_lookup_min(artist, album, spotify_album_id, album_id, bandcamp_update):
-    """Find Bandcamp links for albums."""
-    global dtdb, curdt
+            return None
     
-    bandcamp = None
-    if spotify_album_id:
-        bandcamp_search = bandcamp_url_odesli(spotify_album_id)
-        bandcamp = bandcamp_search[0]
-        bandcamp_update = bandcamp_search[1]
+    return response_cache.cached('odesli', (spotify_album_id,), fetch)
+
+def bandcamp_enrich(db, album_ids=None):
+    """
+    Resolve Bandcamp links via Odesli for up to BANDCAMP_ENRICH_ALBUMS albums (of album_ids, if given)
+    with a Spotify ID that have no link and haven't been checked in BANDCAMP_RECHECK_DAYS. Lookups run
+    concurrently under the Odesli rate limit and each batch of results is written with one executemany.
+    """
+    albums, params = album_filter('a.id', album_ids)
+    sql = f"""
+    SELECT a.id, a.artist, a.album, a.spotify_album_id 
+    FROM music_inventory.last_fm_album_meta a 
+    WHERE a.spotify_album_id IS NOT NULL AND a.bandcamp IS NULL 
+    AND (a.bandcamp_update IS NULL OR a.bandcamp_update < DATE_SUB(NOW(), INTERVAL {BANDCAMP_RECHECK_DAYS} DAY)) 
+    {albums}{{after}}
+    """
     
-    if bandcamp:
-        sql = "UPDATE last_fm_album_meta SET bandcamp=%s, bandcamp_update=%s WHERE id = %s"
-        curdt.execute(sql, (bandcamp, bandcamp_update, album_id))
-        dtdb.commit()
-        message = f'Found Bandcamp link via Odesli for {artist} - {album}: {bandcamp}'
-        print(message)
+    found = 0
+    checked = 0
+    with ThreadPoolExecutor(max_workers=ODESLI_WORKERS) as pool:
+        pending = itertools.islice(iter_keyset(db, sql, 'a.id', params), BANDCAMP_ENRICH_ALBUMS)
+        for batch in chunked(pending, ODESLI_BATCH):
+            futures = [pool.submit(metrics.bind(bandcamp_url_odesli), row[3]) for row in batch]
+            bandcamp_update = whattimeisit()
+            links = []
+            misses = []
+            for row, future in zip(batch, futures):
+                try:
+                    bandcamp = future.result()
+                except Exception as e:
+                    # Leave bandcamp_update alone so a failed lookup is retried next run
+                    print(f"{lineno()} - Odesli lookup failed for {row[1]} - {row[2]}: {str(e)}")
+                    continue
+                if bandcamp:
+                    print(f'Found Bandcamp link via Odesli for {row[1]} - {row[2]}: {bandcamp}')
+                    links.append((bandcamp, bandcamp_update, row[0]))
+                else:
+                    misses.append((bandcamp_update, row[0]))
+            
+            db.uow.executemany("UPDATE music_inventory.last_fm_album_meta SET bandcamp=%s, bandcamp_update=%s WHERE id = %s", links)
+            db.uow.executemany("UPDATE music_inventory.last_fm_album_meta SET bandcamp_update=%s WHERE id = %s", misses)
+            found += len(links)
+            checked += len(batch)
+            metrics.rows(len(batch))
     
-    return bandcamp
+    print(f"{lineno()} - Found Bandcamp links for {found} of {checked} albums")
+
+LD_JSON_RE = re.compile(r'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.S | re.I)
 
-def get_ld_json(url):
-    """Extract JSON+LD data from a webpage."""
+# ISO-8601 durations as Bandcamp writes them, e.g. P00H03M25S
+ISO_DURATION_RE = re.compile(r'^PT?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?$')
+
+# Bandcamp puts its ld+json block in the page head; stop reading if it hasn't turned up by here
+LD_JSON_MAX_BYTES = 2 * 1024 * 1024
+
+def parse_iso_duration(duration):
+    """Convert an ISO-8601 duration like P00H03M25S to milliseconds, or None if it doesn't parse."""
+    match = ISO_DURATION_RE.match(duration or '')
+    if not match or not any(match.groups()):
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours or 0) * 3600000 + int(minutes or 0) * 60000 + int(float(seconds or 0) * 1000)
+
+def get_ld_json(db, url):
+    """
+    Extract JSON+LD data from a webpage. The page is streamed and the download stops
+    as soon as the ld+json script block has been read.
+    """
+    def fetch():
+        with http.get(url, stream=True) as req:
+            req.raise_for_status()
+            req.encoding = req.encoding or 'utf-8'
+            page = ''
+            for chunk in req.iter_content(chunk_size=16384, decode_unicode=True):
+                page += chunk
+                # Only rescan the page when this chunk closed a script tag
+                match = LD_JSON_RE.search(page) if '</script>' in page[-len(chunk) - 9:].lower() else None
+                if match:
+                    return json.loads(match.group(1))
+                if len(page) > LD_JSON_MAX_BYTES:
+                    break
+        return None
+    
     try:
-        parser = "html.parser"
-        req = requests.get(url)
-        soup = BeautifulSoup(req.text, parser)
-        return json.loads("".join(soup.find("script", {"type":"application/ld+json"}).contents))
+        ld_json = response_cache.cached('bandcamp_ld_json', (url,), fetch)
+        if ld_json is None:
+            raise ValueError(f'no ld+json block on {url}')
+        return ld_json
     except Exception as e:
         row_err = lineno()
         message = f'get_ld_json() - failed: {str(e)}'
-        log_error(message, row_err)
+        log_error(db, message, row_err)
         return None
 
-def missing_duration():
-    """Fill in missing duration data from various sources."""
-    global dtdb, curdt
-    
+def bandcamp_track_durations(ld_json):
+    """
+    Map the folded track names on a Bandcamp album page to their durations in ms.
+    Names that fold to nothing are left out, so they can't stand in for each other.
+    """
+    durations = {}
+    for element in ld_json.get("track", {}).get("itemListElement", []):
+        item = element.get("item", {})
+        ms = parse_iso_duration(item.get("duration"))
+        key = fuzzy_tokens(item.get("name") or '')[0]
+        if key and ms:
+            durations.setdefault(key, ms)
+    return durations
+
+def missing_duration(db, album_ids=None):
+    """Fill in missing duration data from various sources (limited to album_ids if given)."""
     print("Finding tracks with missing durations...")
+    track_albums, track_params = album_filter('t.album_meta_id', album_ids)
     # First try Spotify for tracks with no duration
-    sql = """
-    SELECT d.artist, d.album, d.track, t.id, t.duration_ms, a.bandcamp, a.id 
-    FROM music_inventory.last_fm_data d 
-    LEFT JOIN last_fm_track_meta t ON d.track = t.track AND d.artist = t.artist AND d.album = t.album 
-    LEFT JOIN last_fm_album_meta a ON d.artist = a.artist AND d.album = a.album 
-    WHERE d.album != '' AND t.duration_ms = 0 
-    GROUP BY d.artist, d.album, d.track
+    sql = f"""
+    SELECT t.id, t.artist, t.album, t.track, t.duration_ms, a.bandcamp, a.id 
+    FROM music_inventory.last_fm_track_meta t 
+    LEFT JOIN last_fm_album_meta a ON a.id = t.album_meta_id 
+    WHERE t.album != '' AND t.duration_ms = 0 
+    AND EXISTS (SELECT 1 FROM music_inventory.last_fm_data d WHERE d.track_meta_id = t.id) 
+    {track_albums}{{after}}
     """
-    curdt.execute(sql)
-    data = curdt.fetchall()
-    
-    print(f"Found {len(data)} tracks with missing durations")
     
-    for row in data:
-        artist = row[0]
-        album = row[1]
-        track = row[2]
-        row_id = row[3]
+    for row in iter_keyset(db, sql, 't.id', track_params):
+        row_id = row[0]
+        artist = row[1]
+        album = row[2]
+        track = row[3]
+        metrics.rows(1)
         
         search_query = f'album:{album} artist:{artist} track:{track}'
-        lastfm_search = f'track={track}&artist={artist}&album={album}'
         
         try:
             # Try Spotify search first
@@ -651,165 +2135,252 @@ def missing_duration():
                 duration_ms = int(dur_lookup[0]['duration_ms'])
                 
                 sql = "UPDATE music_inventory.last_fm_track_meta SET duration_ms=%s, spotify_id=%s WHERE track = %s AND artist = %s AND album = %s"
-                curdt.execute(sql, (duration_ms, track_id, track, artist, album))
-                dtdb.commit()
+                db.uow.execute(sql, (duration_ms, track_id, track, artist, album))
                 print(f"Updated duration for {artist} - {track} from Spotify: {duration_ms}ms")
         except Exception as e:
             # If Spotify fails, try Last.fm
             try:
-                response = requests.get(f'https://ws.audioscrobbler.com/2.0/?method=track.getInfo&api_key={LASTFM_API_KEY}&{lastfm_search}&format=json')
-                response.raise_for_status()
-                jsonResponse = response.json()
+                lastfm_params = {'method': 'track.getInfo', 'track': track, 'artist': artist, 'album': album}
+                jsonResponse = response_cache.cached('lastfm_track_info', (normalize_query(artist), normalize_query(album), normalize_query(track)),
+                                                     lambda: lastfm_request(lastfm_params),
+                                                     is_miss=lambda r: not r.get('track', {}).get('duration'))
                 
                 duration_ms = int(jsonResponse["track"]["duration"])
                 
                 sql = "UPDATE music_inventory.last_fm_track_meta SET duration_ms=%s WHERE track = %s AND artist = %s AND album = %s"
-                curdt.execute(sql, (duration_ms, track, artist, album))
-                dtdb.commit()
+                db.uow.execute(sql, (duration_ms, track, artist, album))
                 print(f"Updated duration for {artist} - {track} from Last.fm: {duration_ms}ms")
             except Exception as e2:
                 row_err = lineno()
                 message = f'No duration found for {artist} - {track}: {str(e2)}'
-                log_error(message, row_err)
+                log_error(db, message, row_err)
     
-    # Next, try Bandcamp for tracks still missing duration
-    sql = """
-    SELECT d.artist, d.album, a.bandcamp, t.id, t.track, 
-    CASE WHEN min(t.duration_ms) IS NULL THEN 0 ELSE min(t.duration_ms) END 
-    FROM music_inventory.last_fm_data d 
-    INNER JOIN last_fm_track_meta t ON d.track = t.track AND d.artist = t.artist AND d.album = t.album 
-    INNER JOIN last_fm_album_meta a ON d.artist = a.artist AND d.album = a.album 
+    # Next, read the Bandcamp album page once for all of an album's tracks still missing a duration
+    albums, params = album_filter('a.id', album_ids)
+    sql = f"""
+    SELECT a.id, a.artist, a.album, a.bandcamp 
+    FROM music_inventory.last_fm_album_meta a 
     WHERE a.bandcamp IS NOT NULL 
-    GROUP BY d.artist, d.album 
-    HAVING min(t.duration_ms) = 0 OR min(t.duration_ms) IS NULL 
-    LIMIT 4
-    """
-    curdt.execute(sql)
-    data = curdt.fetchall()
-    
-    for row in data:
-        artist = row[0]
-        album = row[1]
-        bandcamp_url = row[2]
-        row_id = row[3]
-        track = row[4]
-        
-        if bandcamp_url:
-            bc_lookup = get_ld_json(bandcamp_url)
-            if bc_lookup:
-                try:
-                    num_tracks = bc_lookup["track"]["numberOfItems"]
-                    for i in range(num_tracks):
-                        try:
-                            track_b = bc_lookup["track"]["itemListElement"][i]["item"]["name"]
-                            duration = bc_lookup["track"]["itemListElement"][i]["item"]["duration"]
-                            
-                            # Parse duration string (format like P00H00M00S)
-                            seconds = re.search("(?<=P\d\dH\d\dM)(.*)(?=S)", duration)
-                            seconds = int(seconds.group()) * 1000
-                            minutes = re.search("(?<=P\d\dH)(.*)(?=M\d\dS)", duration)
-                            minutes = int(minutes.group()) * 60000
-                            hours = re.search("(?<=P)(.*)(?=H\d\dM\d\dS)", duration)
-                            hours = int(hours.group()) * 3600000
-                            ms = hours + minutes + seconds
-                            
-                            if track == track_b:
-                                print(f"Found duration for {artist} - {track} on Bandcamp: {ms}ms")
-                                sql = "UPDATE music_inventory.last_fm_track_meta SET duration_ms=%s WHERE id = %s"
-                                curdt.execute(sql, (ms, row_id))
-                                dtdb.commit()
-                                break
-                        except Exception as e:
-                            row_err = lineno()
-                            message = f'Error parsing Bandcamp track: {str(e)}'
-                            log_error(message, row_err)
-                except Exception as e:
-                    row_err = lineno()
-                    message = f'Error parsing Bandcamp page: {str(e)}'
-                    log_error(message, row_err)
-    
-    # Finally, use average durations for any remaining tracks
-    sql = "SELECT CAST(AVG(t.duration_ms) AS DECIMAL(8,0)) FROM last_fm_track_meta t"
-    curdt.execute(sql)
-    data = curdt.fetchall()
-    all_avg_dur = data[0][0] if data else 240000  # Default to 4 minutes
+    AND EXISTS (SELECT 1 FROM music_inventory.last_fm_track_meta t 
+                WHERE t.album_meta_id = a.id AND (t.duration_ms = 0 OR t.duration_ms IS NULL) 
+                AND EXISTS (SELECT 1 FROM music_inventory.last_fm_data d WHERE d.track_meta_id = t.id)) 
+    {albums}{{after}}
+    """
     
-    sql = """
-    SELECT d.artist, d.album, d.track, t.id 
-    FROM music_inventory.last_fm_data d 
-    LEFT JOIN last_fm_track_meta t ON d.track = t.track AND d.artist = t.artist AND d.album = t.album 
-    LEFT JOIN last_fm_album_meta a ON d.artist = a.artist AND d.album = a.album 
-    WHERE d.album != '' AND t.duration_ms = 0 
-    GROUP BY d.artist, d.album, d.track
-    """
-    curdt.execute(sql)
-    data = curdt.fetchall()
-    
-    for row in data:
-        artist = row[0]
-        album = row[1]
-        track = row[2]
-        track_id = row[3]
+    for row in itertools.islice(iter_keyset(db, sql, 'a.id', params), BANDCAMP_DURATION_ALBUMS):
+        album_id = row[0]
+        artist = row[1]
+        album = row[2]
+        bandcamp_url = row[3]
+        metrics.rows(1)
         
-        # Try to get album average first
-        sql = "SELECT CAST(AVG(t.duration_ms) AS DECIMAL(8,0)) FROM last_fm_track_meta t WHERE t.artist = %s AND t.album = %s GROUP BY t.artist, t.album"
-        curdt.execute(sql, (artist, album))
-        album_data = curdt.fetchall()
+        bc_lookup = get_ld_json(db, bandcamp_url)
+        if not bc_lookup:
+            continue
+        
+        try:
+            durations = bandcamp_track_durations(bc_lookup)
+        except Exception as e:
+            row_err = lineno()
+            message = f'Error parsing Bandcamp page: {str(e)}'
+            log_error(db, message, row_err)
+            continue
         
-        avg_dur = album_data[0][0] if album_data else all_avg_dur
+        db.execute("SELECT id, track FROM music_inventory.last_fm_track_meta WHERE album_meta_id = %s AND (duration_ms = 0 OR duration_ms IS NULL)", (album_id,))
+        updates = []
+        for track_id, track in db.fetchall():
+            key = fuzzy_tokens(track)[0]
+            ms = durations.get(key) if key else None
+            if ms:
+                updates.append((ms, track_id))
         
-        print(f"Using average duration for {artist} - {track}: {avg_dur}ms")
-        sql = "UPDATE music_inventory.last_fm_track_meta SET duration_ms=%s WHERE id = %s"
-        curdt.execute(sql, (avg_dur, track_id))
-        dtdb.commit()
+        if updates:
+            print(f"Found durations for {len(updates)} tracks of {artist} - {album} on Bandcamp")
+            db.uow.executemany("UPDATE music_inventory.last_fm_track_meta SET duration_ms=%s WHERE id = %s", updates)
+    
+    # Finally, give any remaining tracks their album's average known duration,
+    # else the average over all known durations, else 4 minutes
+    db.execute("DROP TEMPORARY TABLE IF EXISTS album_avg_duration")
+    sql = """
+    CREATE TEMPORARY TABLE album_avg_duration (PRIMARY KEY (album_meta_id)) 
+    SELECT t.album_meta_id, SUM(t.duration_ms) AS total_ms, COUNT(*) AS tracks, 
+           CAST(AVG(t.duration_ms) AS DECIMAL(8,0)) AS avg_ms 
+    FROM music_inventory.last_fm_track_meta t 
+    WHERE t.duration_ms > 0 AND t.album_meta_id IS NOT NULL 
+    GROUP BY t.album_meta_id
+    """
+    db.execute(sql)
+    db.execute("SELECT CAST(SUM(total_ms) / SUM(tracks) AS DECIMAL(8,0)) FROM album_avg_duration")
+    all_avg_dur = db.fetchone()[0] or UNKNOWN_DURATION_MS
+    
+    sql = f"""
+    UPDATE music_inventory.last_fm_track_meta t 
+    LEFT JOIN album_avg_duration x ON x.album_meta_id = t.album_meta_id 
+    SET t.duration_ms = COALESCE(x.avg_ms, %s) 
+    WHERE t.album != '' AND t.duration_ms = 0 
+    AND EXISTS (SELECT 1 FROM music_inventory.last_fm_data d WHERE d.track_meta_id = t.id) 
+    {track_albums}
+    """
+    db.uow.execute(sql, (all_avg_dur, *track_params))
+    print(f"Used average durations for {db.rowcount} tracks")
+    metrics.rows(db.rowcount)
+    db.execute("DROP TEMPORARY TABLE album_avg_duration")
 
-def datagather():
+def datagather(db):
     """Main function to gather and enrich music data."""
-    global dtdb, curdt
-    
     print("Starting data gathering process...")
-    create_album()
-    create_track()
-    get_track_id()
-    spotify_meta()
-    missing_duration()
+    with metrics.stage('create_album'):
+        create_album(db)
+    with metrics.stage('create_track'):
+        create_track(db)
+    with metrics.stage('link_scrobble_keys'):
+        link_scrobble_keys(db)
+    # Roll up the new plays before ranking on them; enrichment prices them afterwards
+    with metrics.stage('update_listening_rollup'):
+        update_listening_rollup(db)
+    
+    # Rank every playlist on local data to find the albums that could make their next builds
+    with metrics.stage('playlist_candidates'):
+        candidates = sorted(playlist_candidate_albums(db))
+        metrics.rows(len(candidates))
+    full = ENRICH_MODE != 'demand'
+    album_ids = None if full else candidates
+    if not full:
+        print(f"Demand-driven enrichment for {len(candidates)} playlist candidate albums")
+    
+    with metrics.stage('get_track_id'), db.uow.stage('get_track_id'):
+        get_track_id(db, candidates, full=full)
+    with metrics.stage('spotify_meta'), db.uow.stage('spotify_meta'):
+        spotify_meta(db, album_ids)
+    with metrics.stage('bandcamp_enrich'), db.uow.stage('bandcamp_enrich'):
+        bandcamp_enrich(db, album_ids)
+    with metrics.stage('missing_duration'), db.uow.stage('missing_duration'):
+        missing_duration(db, album_ids)
+    with metrics.stage('reprice_listening_rollup'):
+        reprice_listening_rollup(db)
     print("Data gathering complete")
 
-def playlist_to_db(i, artist, album, spotify_album_id, track, spotify_track_id, bandcamp_url, author_id):
-    """Save playlist track to database."""
-    global dtdb, curdt
-    
-    weekly_insert = [
-        author_id,
-        str(i),
-        artist,
-        album,
-        spotify_album_id,
-        track,
-        spotify_track_id
-    ]
-    
-    if not bandcamp_url:
-        sql = 'INSERT INTO music_inventory.weekly_top_16(user,pl_order,artist,album,album_spotify_id,track,track_spotify_id) VALUES(%s,%s,%s,%s,%s,%s,%s)'
-    else:
-        sql = 'INSERT INTO music_inventory.weekly_top_16(user,pl_order,artist,album,album_spotify_id,track,track_spotify_id,bandcamp_url) VALUES(%s,%s,%s,%s,%s,%s,%s,%s)'
-        weekly_insert.insert(7, bandcamp_url)
-    
+def start_pipeline_run(db):
+    """Record the start of a run and return its id, which tags that run's weekly_top_16 snapshot."""
+    db.execute("INSERT INTO music_inventory.pipeline_run(started_at) VALUES (%s)", (whattimeisit(),))
+    db.commit()
+    return db.lastrowid
+
+def finish_pipeline_run(db, run_id):
+    """Mark a pipeline run as finished."""
+    db.execute("UPDATE music_inventory.pipeline_run SET finished_at = %s WHERE id = %s", (whattimeisit(), run_id))
+    db.commit()
+
+def stored_playlist(db, playlist_id):
+    """Return the latest weekly_top_16 snapshot for a playlist, in playlist order."""
+    sql = """
+    SELECT pl_order, artist, album, album_spotify_id, track, track_spotify_id, bandcamp_url 
+    FROM music_inventory.weekly_top_16 
+    WHERE playlist_id = %s 
+    AND snapshot_id = (SELECT MAX(snapshot_id) FROM music_inventory.weekly_top_16 WHERE playlist_id = %s) 
+    ORDER BY pl_order
+    """
+    db.execute(sql, (playlist_id, playlist_id))
+    return [tuple(row) for row in db.fetchall()]
+
+def playlist_to_db(db, playlist_id, author_id, snapshot_id, entries):
+    """Write a playlist's track list to weekly_top_16 as one snapshot, in a single transaction."""
+    sql = """
+    INSERT INTO music_inventory.weekly_top_16
+    (user, playlist_id, snapshot_id, pl_order, artist, album, album_spotify_id, track, track_spotify_id, bandcamp_url) 
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
     try:
-        curdt.execute(sql, weekly_insert)
-        dtdb.commit()
-        new_row = curdt.lastrowid
-        print(f"Added row {new_row} to weekly_top_16 database")
+        db.executemany(sql, [(author_id, playlist_id, snapshot_id, *entry) for entry in entries])
+        db.commit()
+        print(f"Saved {len(entries)} rows to weekly_top_16 snapshot {snapshot_id} for playlist {playlist_id}")
     except Exception as e:
+        db.rollback()
         row_err = lineno()
-        message = f'Failed updating rows track_meta: {str(e)}'
-        log_error(message, row_err)
+        message = f'Failed updating rows weekly_top_16: {str(e)}'
+        log_error(db, message, row_err)
         print(f"{row_err} - Failed updating weekly_top_16: {e}")
 
-def find_track_for_playlist(artist, album, author_id):
-    """Find or search for a representative track from an album for a playlist."""
-    global dtdb, curdt
+def sync_playlist(db, playlist_id, author_id, snapshot_id, entries):
+    """
+    Bring a Spotify playlist in line with the desired entries
+    (pl_order, artist, album, album_spotify_id, track, track_spotify_id, bandcamp_url)
+    and record them as this run's weekly_top_16 snapshot.
+    The playlist is rewritten with one replace call, and only when its tracks differ
+    from the previous snapshot. Returns 'unchanged' or 'replaced'.
+    """
+    current = stored_playlist(db, playlist_id)
+    
+    desired_ids = [entry[5] for entry in entries if entry[5]]
+    if current and [row[5] for row in current if row[5]] == desired_ids:
+        print(f"Playlist {playlist_id} unchanged, skipping Spotify update")
+        status = 'unchanged'
+    else:
+        uris = [f'spotify:track:{track_id}' for track_id in desired_ids]
+        # No snapshot is written on failure, so the next run retries the replace
+        sp_auth.playlist_replace_items(playlist_id, uris)
+        print(f"Replaced playlist {playlist_id} with {len(uris)} tracks")
+        status = 'replaced'
+    
+    playlist_to_db(db, playlist_id, author_id, snapshot_id, entries)
+    return status
+
+# Most played track of an album for a user over the days before a date.
+# Date bounds are ranges on the raw date_time so idx_user_album_date can be used.
+REPRESENTATIVE_TRACK_SQL = """
+SELECT t.artist, t.album, t.track, t.id, t.spotify_id, a.spotify_album_id, a.id, a.bandcamp, a.bandcamp_update
+FROM music_inventory.last_fm_data d 
+INNER JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+INNER JOIN last_fm_album_meta a ON a.id = d.album_meta_id 
+WHERE a.artist = %s AND a.album = %s and d.`user` = %s 
+AND d.date_time >= DATE_SUB(DATE(%s), INTERVAL %s DAY) AND d.date_time < DATE_ADD(DATE(%s), INTERVAL 1 DAY) 
+GROUP BY t.id, a.id 
+ORDER BY t.sel_priority DESC, COUNT(DISTINCT d.id) DESC, sum(t.duration_ms) DESC LIMIT 1
+"""
+
+VARIOUS_ARTISTS_TRACK_SQL = """
+SELECT t.artist, t.album, t.track, t.id, t.spotify_id, a.spotify_album_id, a.id, a.bandcamp, a.bandcamp_update
+FROM music_inventory.last_fm_data d 
+INNER JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+INNER JOIN last_fm_album_meta a ON a.id = d.album_meta_id 
+WHERE a.album = %s and d.`user` = %s 
+AND d.date_time >= DATE_SUB(DATE(%s), INTERVAL %s DAY) AND d.date_time < DATE_ADD(DATE(%s), INTERVAL 1 DAY) 
+GROUP BY t.id, a.id   
+ORDER BY COUNT(d.id) DESC LIMIT 1
+"""
+
+def select_album_tracks(db, album_ids, author_id, days_ago=365):
+    """
+    Pick the representative track for several albums in one query, using the same
+    ordering as REPRESENTATIVE_TRACK_SQL. Returns {album_meta_id: track row}; albums
+    without a scrobbled track in the window are left out.
+    """
+    if not album_ids:
+        return {}
     
+    start_str = datetime.now().strftime('%Y-%m-%d')
+    placeholders = ','.join(['%s'] * len(album_ids))
+    sql = f"""
+    SELECT artist, album, track, track_id, spotify_id, spotify_album_id, album_id, bandcamp, bandcamp_update 
+    FROM (
+        SELECT t.artist, t.album, t.track, t.id AS track_id, t.spotify_id, a.spotify_album_id, a.id AS album_id, 
+               a.bandcamp, a.bandcamp_update, 
+               ROW_NUMBER() OVER (PARTITION BY a.id 
+                                  ORDER BY t.sel_priority DESC, COUNT(DISTINCT d.id) DESC, sum(t.duration_ms) DESC, t.id) AS pick 
+        FROM music_inventory.last_fm_data d 
+        INNER JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+        INNER JOIN last_fm_album_meta a ON a.id = d.album_meta_id 
+        WHERE d.`user` = %s AND d.album_meta_id IN ({placeholders}) 
+        AND d.date_time >= DATE_SUB(DATE(%s), INTERVAL %s DAY) AND d.date_time < DATE_ADD(DATE(%s), INTERVAL 1 DAY) 
+        GROUP BY t.id, a.id
+    ) ranked 
+    WHERE pick = 1
+    """
+    db.execute(sql, (str(author_id), *album_ids, start_str, days_ago, start_str))
+    return {row[6]: row for row in db.fetchall()}
+
+def find_track_for_playlist(db, artist, album, author_id):
+    """Find or search for a representative track from an album for a playlist."""
     print(f"Finding a track for {artist} - {album}")
     
     # Calculate date range for finding representative track
@@ -819,33 +2390,13 @@ def find_track_for_playlist(artist, album, author_id):
     
     # First try to find an existing track in the database
     if artist == 'Various Artists':
-        sql = f"""
-        SELECT d.artist, d.album, d.track, t.id, t.spotify_id, a.spotify_album_id, a.id, a.bandcamp, a.bandcamp_update
-        FROM music_inventory.last_fm_data d 
-        INNER JOIN last_fm_track_meta t ON d.album = t.album 
-        LEFT JOIN last_fm_album_meta a ON d.album = a.album 
-        WHERE d.album = %s and d.`user` = %s 
-        AND DATE(d.date_time) BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {days_ago} DAY) AND DATE('{start_str}') 
-        GROUP BY t.track, t.album, t.artist   
-        ORDER BY COUNT(d.id) DESC LIMIT 1
-        """
-        curdt.execute(sql, (album, author_id))
+        db.execute(VARIOUS_ARTISTS_TRACK_SQL, (album, str(author_id), start_str, days_ago, start_str))
     else:
-        sql = f"""
-        SELECT d.artist, d.album, d.track, t.id, t.spotify_id, a.spotify_album_id, a.id, a.bandcamp, a.bandcamp_update
-        FROM music_inventory.last_fm_data d 
-        INNER JOIN last_fm_track_meta t ON d.artist = t.artist AND d.track = t.track AND d.album = t.album 
-        INNER JOIN last_fm_album_meta a ON d.artist = a.artist AND d.album = a.album 
-        WHERE d.artist = %s AND d.album = %s and d.`user` = %s 
-        AND DATE(d.date_time) BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {days_ago} DAY) AND DATE('{start_str}') 
-        GROUP BY d.track, d.album, d.artist 
-        ORDER BY t.sel_priority DESC, COUNT(DISTINCT d.id) DESC, sum(t.duration_ms) DESC LIMIT 1
-        """
-        curdt.execute(sql, (artist, album, author_id))
+        db.execute(REPRESENTATIVE_TRACK_SQL, (artist, album, str(author_id), start_str, days_ago, start_str))
     
-    track_data = curdt.fetchall()
+    track_data = db.fetchall()
     
-    if curdt.rowcount > 0:
+    if db.rowcount > 0:
         print(f"Found existing track in database for {artist} - {album}")
         return track_data[0]
     
@@ -854,15 +2405,17 @@ def find_track_for_playlist(artist, album, author_id):
     
     # Find most listened track from this album
     sql = f"""
-    SELECT d.track 
+    SELECT t.track 
     FROM music_inventory.last_fm_data d 
-    WHERE d.artist = %s AND d.album = %s AND d.user = %s 
-    GROUP BY d.track 
+    INNER JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+    INNER JOIN last_fm_album_meta a ON a.id = d.album_meta_id 
+    WHERE a.artist = %s AND a.album = %s AND d.user = %s 
+    GROUP BY t.id 
     ORDER BY COUNT(d.id) DESC 
     LIMIT 1
     """
-    curdt.execute(sql, (artist, album, author_id))
-    best_track = curdt.fetchone()
+    db.execute(sql, (artist, album, str(author_id)))
+    best_track = db.fetchone()
     
     if not best_track:
         # No data at all for this album, just use a generic track name
@@ -873,15 +2426,15 @@ def find_track_for_playlist(artist, album, author_id):
     
     # Get album ID first (or create it if it doesn't exist)
     sql = "SELECT id, spotify_album_id, bandcamp, bandcamp_update FROM last_fm_album_meta WHERE artist = %s AND album = %s"
-    curdt.execute(sql, (artist, album))
-    album_data = curdt.fetchall()
+    db.execute(sql, (artist, album))
+    album_data = db.fetchall()
     
-    if curdt.rowcount == 0:
+    if db.rowcount == 0:
         # Create album entry
         sql = "INSERT INTO music_inventory.last_fm_album_meta(artist, album) VALUES (%s, %s)"
-        curdt.execute(sql, (artist, album))
-        dtdb.commit()
-        album_id = curdt.lastrowid
+        db.execute(sql, (artist, album))
+        db.commit()
+        album_id = db.lastrowid
         spotify_album_id = None
         bandcamp_url = None
         bandcamp_update = None
@@ -895,19 +2448,23 @@ def find_track_for_playlist(artist, album, author_id):
     spotify_track_id = None
     spotify_album_id = None
     
-    # Try strict search first
-    track_found = search_spotify(artist, album, track_name, 1, 1, strict=True)
+    # Try the album listing first, it is usually cached from get_track_id
+    known_album_id = album_data[0][1] if album_data else None
+    track_found = not resolve_album_tracks(db, artist, album, [track_name], known_album_id)
+    
+    if not track_found:
+        track_found = search_spotify(db, artist, album, track_name, 1, 1, strict=True)
     
     if not track_found:
         print("No matches found with strict search, trying relaxed search...")
-        track_found = search_spotify(artist, album, track_name, 1, 1, strict=False)
+        track_found = search_spotify(db, artist, album, track_name, 1, 1, strict=False)
     
     # If we found the track through search_spotify, get its ID
     if track_found:
         # Retrieve the updated track info from database
         sql = "SELECT spotify_id, spotify_album_id FROM last_fm_track_meta WHERE artist = %s AND album = %s AND track = %s"
-        curdt.execute(sql, (artist, album, track_name))
-        track_info = curdt.fetchone()
+        db.execute(sql, (artist, album, track_name))
+        track_info = db.fetchone()
         
         if track_info:
             spotify_track_id = track_info[0]
@@ -915,10 +2472,10 @@ def find_track_for_playlist(artist, album, author_id):
             print(f"Found track ID {spotify_track_id} for {artist} - {track_name}")
             
             # Update album with Spotify ID if needed
-            if spotify_album_id and not album_data[0][1]:
+            if spotify_album_id and not known_album_id:
                 sql = "UPDATE music_inventory.last_fm_album_meta SET spotify_album_id = %s WHERE id = %s"
-                curdt.execute(sql, (spotify_album_id, album_id))
-                dtdb.commit()
+                db.execute(sql, (spotify_album_id, album_id))
+                db.commit()
     
     # If still not found, try a direct album search as a fallback
     if not spotify_track_id:
@@ -939,23 +2496,20 @@ def find_track_for_playlist(artist, album, author_id):
                 VALUES (%s, %s, %s, %s, %s, %s, %s)
                 """
                 scan_time = whattimeisit()
-                curdt.execute(sql, (artist, album, track_name, spotify_track_id, scan_time, spotify_album_id, scan_time))
-                dtdb.commit()
-                track_id = curdt.lastrowid
+                db.execute(sql, (artist, album, track_name, spotify_track_id, scan_time, spotify_album_id, scan_time))
+                db.commit()
+                track_id = db.lastrowid
                 
                 # Update album with Spotify ID
                 sql = "UPDATE music_inventory.last_fm_album_meta SET spotify_album_id = %s WHERE id = %s"
-                curdt.execute(sql, (spotify_album_id, album_id))
-                dtdb.commit()
+                db.execute(sql, (spotify_album_id, album_id))
+                db.commit()
                 
                 print(f"Found and added new track '{track_name}' from Spotify search")
         except Exception as e:
             print(f"Error in fallback Spotify search: {e}")
     
-    # Try to get Bandcamp URL if missing
-    if not bandcamp_url and spotify_album_id:
-        bandcamp_url = bandcamp_lookup_min(artist, album, spotify_album_id, album_id, bandcamp_update)
-    
+    # Bandcamp links are filled in by the bandcamp_enrich stage, never looked up here
     if spotify_track_id:
         return (artist, album, track_name, track_id if 'track_id' in locals() else None, 
                 spotify_track_id, spotify_album_id, album_id, bandcamp_url, bandcamp_update)
@@ -963,160 +2517,287 @@ def find_track_for_playlist(artist, album, author_id):
         print(f"No tracks found on Spotify for {artist} - {album}")
         return None
 
-def main():
-    """Main execution function that runs the full process."""
-    global dtdb, curdt
-    
-    # Make sure database is connected
-    if dtdb is None or curdt is None:
-        print("Database connection not established, connecting now...")
-        connect_to_db()
+# =============================================================================
+# PIPELINE
+# =============================================================================
+
+def run_job(func, job):
+    """Run one pipeline job on its own pooled connection, measured as a stage named after func."""
+    with metrics.stage(func.__name__, f"{job[1]}/{job[3]}") as record:
+        with db_pool.session() as db:
+            result = func(db, job)
+        record['ok'] = result['ok']
+        record['error'] = result['error']
+        return result
+
+def run_stage(func, jobs):
+    """
+    Run func over every job on the worker threads and return one result per job.
+    Each job checks out its own connection; the threads share the API rate limiters.
+    A job that crashes is reported as failed instead of stopping the run.
+    """
+    workers = min(PIPELINE_WORKERS, len(jobs))
+    results = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [pool.submit(run_job, func, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'job': f"{job[1]}/{job[3]}", 'stage': func.__name__, 'ok': False, 'error': str(e)})
+    return results
+
+def sync_user(db, user):
+    """Pipeline stage: pull a user's new Last.fm scrobbles."""
+    author_id = str(user[0])
+    lastfm_id = user[1]
+    playlist_id = user[3]
+    period = user[4]
+    release_year = user[5]
+    keep_updated = user[6]
+    years_ago = user[7]
+    play_year = user[8]
+    populated = user[9]
+    
+    result = {'job': f"{lastfm_id}/{playlist_id}", 'stage': 'sync_user', 'ok': True, 'error': None}
+    print(f"\nProcessing user: {lastfm_id} (ID: {author_id})")
     
-    print("Starting top albums processing script...")
-    start_time = time.time()
+    try:
+        # Update Last.fm data
+        update_lastfm_data(db, author_id, lastfm_id, period, release_year, keep_updated, years_ago, play_year, playlist_id, populated)
+    except Exception as e:
+        row_err = lineno()
+        message = f"Sync failed for {lastfm_id}: {e}"
+        log_error(db, message, row_err)
+        print(f"Error: {message}")
+        result['ok'] = False
+        result['error'] = str(e)
     
-    # Step 1: Get the list of users with playlists
-    sql = """
-    SELECT up.id, u.lastfm_id, u.email_address, up.playlist_id, up.period, 
-           up.release_year, up.keep_updated, up.years_ago, up.play_year, up.populated 
-    FROM music_inventory.users u 
-    INNER JOIN music_inventory.users_playlists up on u.id = up.user_id 
-    WHERE u.approved = 'YES' 
-    ORDER BY up.id ASC
+    return result
+
+def rollup_covers_user(db, author_id):
+    """
+    The rollup stores whole hours, so it can only apply a user's excluded time range
+    when that range starts and ends on the hour.
+    """
+    db.execute("SELECT start_time, end_time FROM music_inventory.users WHERE id = %s", (author_id,))
+    row = db.fetchone()
+    if not row:
+        return False
+    # MySQLdb returns TIME columns as timedeltas
+    return all(value is None or value.total_seconds() % 3600 == 0 for value in row)
+
+def ranking_sql(db, author_id, period, release_year, years_ago, songs_only, use_rollup=True, candidates=False):
+    """
+    Build the album ranking query for a playlist. Plays without a known duration count as
+    UNKNOWN_DURATION_MS. With candidates, tracks not enriched yet (no release date or audio
+    features) pass the release year and songs only filters, so they can be picked for enrichment.
     """
-    curdt.execute(sql)
-    users = curdt.fetchall()
     
-    print(f"Found {len(users)} users with playlists to process")
+    # Build query conditions
+    songs_only_q = ''
+    songs_only_q_b = ''
+    if songs_only == 'TRUE':
+        songs_only_q = 'duration_ms < 300000 AND '
+        songs_only_q_b = 'HAVING AVG(instrumentalness) < 0.35'
+        if candidates:
+            songs_only_q_b = 'HAVING COALESCE(AVG(instrumentalness), 0) < 0.35'
+    release_year_q = f"t.release_date LIKE '{release_year}%'"
+    if candidates:
+        release_year_q = f"(t.release_date LIKE '{release_year}%' OR t.release_date IS NULL)"
     
-    # Step 2: Process each user's playlist
-    for user in users:
-        author_id = str(user[0])
-        lastfm_id = user[1]
-        email = user[2]
-        playlist_id = user[3]
-        period = user[4]
-        release_year = user[5]
-        keep_updated = user[6]
-        years_ago = user[7]
-        play_year = user[8]
-        populated = user[9]
-        
-        print(f"\nProcessing user: {lastfm_id} (ID: {author_id})")
-        
-        # Step 2a: Clear existing playlist
+    if period == 'WEEK':
+        day_length = 7
+    else:
+        day_length = 365
+    
+    # Calculate date range
+    start = datetime.now() - relativedelta(years=int(years_ago))
+    start_str = start.strftime('%Y-%m-%d')
+    
+    # Plain rankings read the hourly rollup; track-level filters need the raw scrobbles
+    if use_rollup and release_year == 'ALL' and songs_only != 'TRUE' and rollup_covers_user(db, author_id):
+        sql = f"""
+        SELECT a.artist, a.album, sum(r.duration_ms + r.unpriced_plays * {UNKNOWN_DURATION_MS}), a.id 
+        FROM music_inventory.listening_rollup r 
+        INNER JOIN users u on r.`user` = u.id  
+        INNER JOIN last_fm_album_meta a ON a.id = r.album_meta_id 
+        WHERE r.user = '{author_id}' 
+        AND r.play_date >= DATE_SUB(DATE('{start_str}'), INTERVAL {day_length} DAY) AND r.play_date < DATE('{start_str}') 
+        AND case when u.start_time < u.end_time 
+                then (r.play_hour < hour(u.start_time) or r.play_hour >= hour(u.end_time)) 
+            when u.start_time > u.end_time 
+                then (r.play_hour < hour(u.start_time) and r.play_hour >= hour(u.end_time)) 
+            else r.`user` = u.id end 
+        GROUP BY a.id 
+        ORDER BY sum(r.duration_ms + r.unpriced_plays * {UNKNOWN_DURATION_MS}) DESC
+        """
+    # Build query based on release year filter
+    elif release_year != 'ALL':
+        sql = f"""
+        SELECT a.artist, a.album, sum({PLAY_DURATION_SQL}), a.id 
+        FROM music_inventory.last_fm_data d 
+        INNER JOIN users u on d.`user` = u.id  
+        INNER JOIN last_fm_album_meta a ON a.id = d.album_meta_id 
+        LEFT JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+        WHERE {songs_only_q}d.user = '{author_id}' 
+        AND d.date_time BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {day_length} DAY) AND DATE('{start_str}') 
+        AND {release_year_q} 
+        AND t.re_release is null 
+        AND case when u.start_time < u.end_time 
+                then (d.play_time < u.start_time or d.play_time > u.end_time) 
+            when u.start_time > u.end_time 
+                then (d.play_time < u.start_time and d.play_time > u.end_time) 
+            else d.`user` = u.id end 
+        GROUP BY a.id {songs_only_q_b}
+        ORDER BY sum({PLAY_DURATION_SQL}) DESC
+        """
+    else:
+        sql = f"""
+        SELECT a.artist, a.album, sum({PLAY_DURATION_SQL}), a.id 
+        FROM music_inventory.last_fm_data d 
+        INNER JOIN users u on d.`user` = u.id  
+        INNER JOIN last_fm_album_meta a ON a.id = d.album_meta_id 
+        LEFT JOIN last_fm_track_meta t ON t.id = d.track_meta_id 
+        WHERE {songs_only_q}d.user = '{author_id}' 
+        AND d.date_time BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {day_length} DAY) AND DATE('{start_str}')  
+        AND case when u.start_time < u.end_time 
+            then (d.play_time < u.start_time or d.play_time > u.end_time) 
+            when u.start_time > u.end_time 
+            then (d.play_time < u.start_time and d.play_time > u.end_time) 
+            else d.`user` = u.id end 
+        GROUP BY a.id  {songs_only_q_b}
+        ORDER BY sum({PLAY_DURATION_SQL}) DESC
+        """
+    
+    return sql
+
+def rank_albums(db, author_id, period, release_year, years_ago, songs_only, candidates=False):
+    """Rank a user's albums for a playlist by total listening time."""
+    db.execute(ranking_sql(db, author_id, period, release_year, years_ago, songs_only, candidates=candidates))
+    return db.fetchall()
+
+# Playlists to build, one row per users_playlists entry
+PLAYLIST_USERS_SQL = """
+SELECT u.id, u.lastfm_id, u.email_address, up.playlist_id, up.period, 
+       up.release_year, up.keep_updated, up.years_ago, up.songs_only 
+FROM music_inventory.users u 
+INNER JOIN music_inventory.users_playlists up on u.id = up.user_id 
+WHERE u.approved = 'YES' 
+ORDER BY up.id DESC
+"""
+
+def playlist_candidate_albums(db, depth=None):
+    """
+    Rank every playlist on local data and return the ids of the albums that could make
+    its next build: the top depth (PLAYLIST_CANDIDATE_ALBUMS) of each ranking.
+    """
+    depth = depth or PLAYLIST_CANDIDATE_ALBUMS
+    db.execute(PLAYLIST_USERS_SQL)
+    album_ids = set()
+    for user in db.fetchall():
         try:
-            print(f"Clearing playlist: {playlist_id}")
-            old_tracks = []
-            sp_auth.user_playlist_replace_tracks(user='dt10111', playlist_id=playlist_id, tracks=old_tracks)
+            albums = rank_albums(db, user[0], user[4], user[5], user[7], user[8], candidates=True)
         except Exception as e:
-            print(f"Error clearing playlist: {e}")
-        
-        # Step 2b: Update Last.fm data
-        update_lastfm_data(author_id, lastfm_id, period, release_year, keep_updated, years_ago, play_year, playlist_id, populated)
+            print(f"{lineno()} - Could not rank albums for {user[1]}/{user[3]}: {str(e)}")
+            continue
+        album_ids.update(row[3] for row in albums[:depth])
+    return album_ids
+
+def explain_hot_queries(db, author_id):
+    """
+    EXPLAIN the per-playlist queries on last_fm_data for one user and report the index each uses.
+    Returns False if any of them scans last_fm_data without an index, or if a plan doesn't
+    read last_fm_data at all (the query was answered without looking at it, so nothing was checked).
+    """
+    start_str = datetime.now().strftime('%Y-%m-%d')
+    # The representative track query looks up one album; use the user's latest so the plan is real
+    sql = """
+    SELECT a.artist, a.album 
+    FROM music_inventory.last_fm_data d 
+    INNER JOIN music_inventory.last_fm_album_meta a ON a.id = d.album_meta_id 
+    WHERE d.user = %s 
+    ORDER BY d.date_time DESC LIMIT 1
+    """
+    db.execute(sql, (str(author_id),))
+    album = db.fetchone()
+    if not album:
+        print(f"No linked scrobbles for user {author_id} to explain the queries with")
+        return False
+    queries = [
+        ('ranking (raw)', ranking_sql(db, author_id, 'YEAR', 'ALL', '0', 'TRUE', use_rollup=False), None),
+        ('ranking (release year)', ranking_sql(db, author_id, 'YEAR', str(datetime.now().year), '0', 'FALSE', use_rollup=False), None),
+        ('representative track', REPRESENTATIVE_TRACK_SQL, (album[0], album[1], str(author_id), start_str, 365, start_str)),
+    ]
     
-    # Step 3: Process and enrich the music data
-    print("\nEnriching music data...")
-    datagather()
+    ok = True
+    for name, sql, params in queries:
+        db.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in db.description]
+        plans = [dict(zip(columns, row)) for row in db.fetchall()]
+        if not any(plan.get('table') == 'd' for plan in plans):
+            print(f"{name:<25} last_fm_data not in the plan ({plans[0].get('Extra') if plans else 'no rows'}) NOT CHECKED")
+            ok = False
+        for plan in plans:
+            if plan.get('table') != 'd':
+                continue
+            used = plan.get('key')
+            status = 'ok'
+            if plan.get('type') == 'ALL' or not used:
+                status = 'FULL SCAN'
+                ok = False
+            print(f"{name:<25} last_fm_data key={used} type={plan.get('type')} rows={plan.get('rows')} extra={plan.get('Extra')} {status}")
+    return ok
+
+def build_playlist(db, user):
+    """Pipeline stage: rank a user's albums, pick a track per album and push the playlist."""
+    author_id = user[0]
+    lastfm_id = user[1]
+    playlist_id = user[3]
+    period = user[4]
+    release_year = user[5]
+    years_ago = user[7]
+    songs_only = user[8]
+    snapshot_id = user[9]
+    
+    result = {'job': f"{lastfm_id}/{playlist_id}", 'stage': 'build_playlist', 'ok': True, 'error': None}
+    print(f"\nBuilding playlist for user: {lastfm_id} (ID: {author_id})")
     
-    # Step 4: Get user list again for playlist creation
-    sql = """
-    SELECT u.id, u.lastfm_id, u.email_address, up.playlist_id, up.period, 
-           up.release_year, up.keep_updated, up.years_ago, up.songs_only 
-    FROM music_inventory.users u 
-    INNER JOIN music_inventory.users_playlists up on u.id = up.user_id 
-    WHERE u.approved = 'YES' 
-    ORDER BY up.id DESC
-    """
-    curdt.execute(sql)
-    users = curdt.fetchall()
-    
-    # Step 5: Create playlists for each user
-    for user in users:
-        author_id = user[0]
-        lastfm_id = user[1]
-        playlist_id = user[3]
-        period = user[4]
-        release_year = user[5]
-        years_ago = user[7]
-        songs_only = user[8]
-        
-        print(f"\nBuilding playlist for user: {lastfm_id} (ID: {author_id})")
-        
-        # Build query conditions
-        songs_only_q = ''
-        songs_only_q_b = ''
-        if songs_only == 'TRUE':
-            songs_only_q = 'duration_ms < 300000 AND '
-            songs_only_q_b = 'HAVING AVG(instrumentalness) < 0.35'
-        
-        if period == 'WEEK':
-            day_length = 7
-        else:
-            day_length = 365
-        
-        # Calculate date range
-        start = datetime.now() - relativedelta(years=int(years_ago))
-        days_ago = (1 + (int(years_ago) * 365)) + day_length
-        start_str = start.strftime('%Y-%m-%d')
-        
-        # Build query based on release year filter
-        if release_year != 'ALL':
-            sql = f"""
-            SELECT d.artist, d.album, sum(t.duration_ms) 
-            FROM music_inventory.last_fm_data d 
-            INNER JOIN users u on d.`user` = u.id  
-            LEFT JOIN last_fm_track_meta t ON d.track = t.track AND d.album = t.album AND d.artist = t.artist 
-            WHERE {songs_only_q}d.user = {author_id} 
-            AND date_time BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {day_length} DAY) AND DATE('{start_str}') 
-            AND t.release_date LIKE '{release_year}%' 
-            AND t.re_release is null 
-            AND case when u.start_time < u.end_time 
-                    then (time(date_time) < u.start_time or time(date_time) > u.end_time) 
-                when u.start_time > u.end_time 
-                    then (time(date_time) < u.start_time and time(date_time) > u.end_time) 
-                else d.`user` = u.id end 
-            GROUP BY artist, album {songs_only_q_b}
-            ORDER BY sum(t.duration_ms) DESC
-            """
-        else:
-            sql = f"""
-            SELECT d.artist, d.album, sum(t.duration_ms) 
-            FROM music_inventory.last_fm_data d 
-            INNER JOIN users u on d.`user` = u.id  
-            LEFT JOIN last_fm_track_meta t ON d.track = t.track AND d.album = t.album AND d.artist = t.artist 
-            WHERE {songs_only_q}d.user = {author_id} 
-            AND date_time BETWEEN DATE_SUB(DATE('{start_str}'), INTERVAL {day_length} DAY) AND DATE('{start_str}')  
-            AND case when u.start_time < u.end_time 
-                then (time(date_time) < u.start_time or time(date_time) > u.end_time) 
-                when u.start_time > u.end_time 
-                then (time(date_time) < u.start_time and time(date_time) > u.end_time) 
-                else d.`user` = u.id end 
-            GROUP BY artist, album  {songs_only_q_b}
-            ORDER BY sum(t.duration_ms) DESC
-            """
-        
-        curdt.execute(sql)
-        albums = curdt.fetchall()
+    try:
+        with metrics.phase('rank'):
+            albums = rank_albums(db, author_id, period, release_year, years_ago, songs_only)
         
         print(f"Found {len(albums)} albums for this user, selecting top 16")
         
-        # Add top albums to playlist
+        # Collect the top albums for the playlist
         rank = 1  # Album rank counter
-        added_count = 1  # Counter for tracks actually added to playlist
+        added_count = 1  # Counter for tracks with a Spotify ID
+        selected = {}
+        entries = []
+        select_seconds = 0.0
 
-        for album_data in albums:
+        for i, album_data in enumerate(albums):
             if added_count > 16:
                 break  # Limit to 16 tracks
                     
             artist = album_data[0]
             album = album_data[1]
+            album_id = album_data[3]
             
             print(f"Album #{rank}: {artist} - {album}")
-            add_success = 0
             
-            # Call our new function to find a track from this album
-            track_data = find_track_for_playlist(artist, album, author_id)
+            stage_start = time.monotonic()
+            # Resolve the next batch of ranked albums from the database in one query.
+            # Various Artists compilations are matched by title only, so they keep the per-album lookup.
+            if i % PLAYLIST_SELECT_BATCH == 0:
+                batch_ids = [row[3] for row in albums[i:i + PLAYLIST_SELECT_BATCH] if row[0] != 'Various Artists']
+                selected = select_album_tracks(db, batch_ids, author_id)
+            track_data = selected.get(album_id)
+            if track_data:
+                print(f"Found existing track in database for {artist} - {album}")
+            else:
+                # Only albums missing from the database go out to the network
+                track_data = find_track_for_playlist(db, artist, album, author_id)
             
             if track_data:
                 # Unpack the data returned from find_track_for_playlist
@@ -1130,43 +2811,108 @@ def main():
                 bandcamp_url = track_data[7]
                 bandcamp_update = track_data[8]
                 
-                # Add track to Spotify playlist
                 if spotify_track_id:
-                    try:
-                        add_track = f'spotify:track:{spotify_track_id}'
-                        sp_auth.playlist_add_items(playlist_id, [add_track], position=None)
-                        print(f"Track '{track}' added to playlist")
-                        add_success = 1
-                    except Exception as e:
-                        print(f"Failed to add track to playlist: {e}")
+                    print(f"Track '{track}' selected for playlist")
+                    added_count += 1
                 else:
                     print("No Spotify ID for this album/song")
                 
-                # Save to playlist database
-                playlist_to_db(rank, artist, album, spotify_album_id, track, spotify_track_id, bandcamp_url, author_id)
+                entries.append((rank, artist, album, spotify_album_id, track, spotify_track_id, bandcamp_url))
             else:
                 print(f"Error: No tracks found for {artist} - {album}")
-            
-            if add_success > 0:
-                added_count += 1
+            select_seconds += time.monotonic() - stage_start
             
             rank += 1
             print("------------")
+        
+        metrics.count('phases', 'select', select_seconds)
+        
+        # Push the whole track list in one go, or not at all when nothing changed
+        metrics.rows(len(entries))
+        with metrics.phase('push'):
+            metrics.count('playlists', sync_playlist(db, playlist_id, author_id, snapshot_id, entries))
+    except Exception as e:
+        row_err = lineno()
+        message = f"Playlist build failed for {lastfm_id}/{playlist_id}: {e}"
+        log_error(db, message, row_err)
+        print(f"Error: {message}")
+        result['ok'] = False
+        result['error'] = str(e)
+    
+    return result
+
+def main(db):
+    """Main execution function that runs the full process."""
+    print("Starting top albums processing script...")
+    start_time = time.time()
+    run_id = start_pipeline_run(db)
+    metrics.run_id = run_id
+    
+    # Step 1: Get the list of users with playlists
+    sql = """
+    SELECT up.id, u.lastfm_id, u.email_address, up.playlist_id, up.period, 
+           up.release_year, up.keep_updated, up.years_ago, up.play_year, up.populated 
+    FROM music_inventory.users u 
+    INNER JOIN music_inventory.users_playlists up on u.id = up.user_id 
+    WHERE u.approved = 'YES' 
+    ORDER BY up.id ASC
+    """
+    db.execute(sql)
+    users = db.fetchall()
+    
+    print(f"Found {len(users)} users with playlists to process")
+    
+    # Step 2: Update Last.fm data for every user in parallel
+    run_stage(sync_user, users)
+    
+    # Step 3: Process and enrich the music data
+    print("\nEnriching music data...")
+    datagather(db)
+    
+    # Step 4: Get user list again for playlist creation
+    db.execute(PLAYLIST_USERS_SQL)
+    # Every playlist built in this run is written under the run's snapshot id
+    users = [user + (run_id,) for user in db.fetchall()]
+    
+    # Step 5: Create playlists for each user in parallel
+    run_stage(build_playlist, users)
+    
+    finish_pipeline_run(db, run_id)
+    metrics.print_summary()
     
     total_time = time.time() - start_time
+    metrics.write_prometheus(total_time)
     print(f"\nScript completed in {total_time:.2f} seconds")
 
 # Execute the main function if this script is run directly
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build Spotify playlists from Last.fm listening history.")
+    parser.add_argument('--backfill-keys', action='store_true',
+                        help="fill track/album ids on existing scrobbles and exit")
+    parser.add_argument('--rebuild-rollup', action='store_true',
+                        help="recompute listening_rollup from all scrobbles and exit")
+    parser.add_argument('--explain', metavar='USER_ID',
+                        help="check the playlist queries use last_fm_data indexes for a user and exit")
+    args = parser.parse_args()
+    
     try:
         print("Starting script execution...")
         
-        # Initialize the database connection before running main function
+        # Check out the main thread's connection before running main function
         print("Connecting to database...")
-        connect_to_db()
-        
-        print("Database connection successful, running main function...")
-        main()
+        with db_pool.session() as db:
+            if args.backfill_keys:
+                print("Backfilling scrobble track/album ids...")
+                link_scrobble_keys(db, backfill=True)
+            elif args.rebuild_rollup:
+                print("Rebuilding listening rollup...")
+                update_listening_rollup(db, rebuild=True)
+            elif args.explain:
+                if not explain_hot_queries(db, args.explain):
+                    sys.exit("Some playlist queries are not using an index on last_fm_data")
+            else:
+                print("Database connection successful, running main function...")
+                main(db)
         
         print("Script completed successfully!")
     except Exception as e:
@@ -0,0 +1,75 @@
+-- Upgrade steps for databases created from an older music-inventory-schema.sql
+-- Run each section once, in order. New installs only need music-inventory-schema.sql.
+
+USE music_inventory;
+
+-- Integer track/album keys on scrobbles
+ALTER TABLE last_fm_data
+    ADD COLUMN track_meta_id INT DEFAULT NULL AFTER date_time,
+    ADD COLUMN album_meta_id INT DEFAULT NULL AFTER track_meta_id,
+    ADD INDEX idx_track_meta_id (track_meta_id),
+    ADD INDEX idx_album_meta_id (album_meta_id);
+ALTER TABLE last_fm_track_meta
+    ADD COLUMN album_meta_id INT DEFAULT NULL AFTER sel_priority,
+    ADD INDEX idx_album_meta_id (album_meta_id);
+-- Then fill the new columns for existing history:
+--   python main.py --backfill-keys
+-- Once the backfill has finished, the string indexes on last_fm_data are no longer used:
+ALTER TABLE last_fm_data
+    DROP INDEX idx_artist_album,
+    DROP INDEX idx_artist_album_track;
+
+-- Listening rollup for playlist ranking: create listening_rollup from
+-- music-inventory-schema.sql (CREATE TABLE IF NOT EXISTS is safe to re-run).
+-- It is filled on the next run, or immediately with:
+--   python main.py --rebuild-rollup
+
+-- Covering indexes for the playlist date-window and time-of-day queries
+ALTER TABLE last_fm_data
+    ADD COLUMN play_time TIME AS (TIME(date_time)) STORED AFTER album_meta_id,
+    ADD INDEX idx_user_date_time (user, date_time, play_time, album_meta_id, track_meta_id),
+    ADD INDEX idx_user_album_date (user, album_meta_id, date_time, track_meta_id),
+    DROP INDEX idx_user;
+-- Check the playlist queries pick them up (USER_ID is the numeric users.id):
+--   python main.py --explain USER_ID
+
+-- Diff-based playlist sync: weekly_top_16 holds the current tracks of each playlist
+ALTER TABLE weekly_top_16
+    ADD COLUMN playlist_id VARCHAR(255) DEFAULT NULL AFTER user,
+    ADD INDEX idx_playlist_order (playlist_id, pl_order);
+-- Older rows have no playlist_id and are left as history; each playlist is
+-- rewritten once on the first run after this change.
+
+-- Per-run weekly_top_16 snapshots: create pipeline_run from
+-- music-inventory-schema.sql, then
+ALTER TABLE weekly_top_16
+    ADD COLUMN snapshot_id INT DEFAULT NULL AFTER playlist_id,
+    ADD INDEX idx_user_snapshot (user, snapshot_id),
+    ADD INDEX idx_playlist_snapshot (playlist_id, snapshot_id, pl_order),
+    DROP INDEX idx_playlist_order,
+    DROP INDEX idx_user;
+
+-- Exponential backoff for tracks Spotify search can't match
+ALTER TABLE last_fm_track_meta
+    ADD COLUMN spotify_id_attempts INT NOT NULL DEFAULT 0 AFTER spotify_id_scan,
+    ADD COLUMN spotify_id_next_scan DATETIME DEFAULT NULL AFTER spotify_id_attempts,
+    ADD INDEX idx_spotify_id_next_scan (spotify_id_next_scan);
+-- Keep the old 14 day retry for tracks that have already missed once
+UPDATE last_fm_track_meta
+SET spotify_id_next_scan = DATE_ADD(spotify_id_scan, INTERVAL 14 DAY), spotify_id_attempts = 1
+WHERE spotify_id IS NULL AND spotify_id_scan IS NOT NULL;
+
+-- Rollup plays counted before their track durations are known
+-- (skip if listening_rollup was created with unpriced_plays already)
+ALTER TABLE listening_rollup
+    ADD COLUMN unpriced_plays INT NOT NULL DEFAULT 0 AFTER plays;
+-- Existing rows may hold plays rolled up at 0 ms; recompute them with:
+--   python main.py --rebuild-rollup
+
+-- Reprice rollup hours whose track durations change after they were rolled up
+ALTER TABLE last_fm_track_meta
+    ADD COLUMN rollup_duration_ms INT DEFAULT 0 AFTER duration_ms,
+    ADD COLUMN duration_changed TINYINT AS (NOT (duration_ms <=> rollup_duration_ms)) STORED AFTER rollup_duration_ms,
+    ADD INDEX idx_duration_changed (duration_changed);
+-- The rollup currently counts the current durations (after a rebuild); mark them as counted:
+UPDATE last_fm_track_meta SET rollup_duration_ms = duration_ms;
@@ -44,10 +44,14 @@ CREATE TABLE IF NOT EXISTS last_fm_data (
     album VARCHAR(255) NOT NULL,
     track VARCHAR(255) NOT NULL,
     date_time DATETIME NOT NULL,
+    track_meta_id INT DEFAULT NULL,
+    album_meta_id INT DEFAULT NULL,
+    play_time TIME AS (TIME(date_time)) STORED,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    INDEX idx_user (user),
-    INDEX idx_artist_album (artist, album),
-    INDEX idx_artist_album_track (artist, album, track),
+    INDEX idx_user_date_time (user, date_time, play_time, album_meta_id, track_meta_id),
+    INDEX idx_user_album_date (user, album_meta_id, date_time, track_meta_id),
+    INDEX idx_track_meta_id (track_meta_id),
+    INDEX idx_album_meta_id (album_meta_id),
     INDEX idx_date_time (date_time)
 );
 
@@ -73,6 +77,8 @@ CREATE TABLE IF NOT EXISTS last_fm_track_meta (
     track VARCHAR(255) NOT NULL,
     spotify_id VARCHAR(255) DEFAULT NULL,
     spotify_id_scan TIMESTAMP NULL DEFAULT NULL,
+    spotify_id_attempts INT NOT NULL DEFAULT 0,
+    spotify_id_next_scan DATETIME DEFAULT NULL,
     spotify_album_id VARCHAR(255) DEFAULT NULL,
     scantime TIMESTAMP NULL DEFAULT NULL,
     danceability DECIMAL(5,4) DEFAULT NULL,
@@ -87,19 +93,28 @@ CREATE TABLE IF NOT EXISTS last_fm_track_meta (
     instrumentalness DECIMAL(5,4) DEFAULT NULL,
     liveness DECIMAL(5,4) DEFAULT NULL,
     duration_ms INT DEFAULT 0,
+    -- Duration listening_rollup has counted this track's plays at; repriced when it differs
+    rollup_duration_ms INT DEFAULT 0,
+    duration_changed TINYINT AS (NOT (duration_ms <=> rollup_duration_ms)) STORED,
     release_date DATE DEFAULT NULL,
     re_release ENUM('YES', 'NO') DEFAULT NULL,
     sel_priority INT DEFAULT 0,
+    album_meta_id INT DEFAULT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     UNIQUE KEY idx_artist_album_track (artist, album, track),
-    INDEX idx_spotify_id (spotify_id)
+    INDEX idx_spotify_id (spotify_id),
+    INDEX idx_spotify_id_next_scan (spotify_id_next_scan),
+    INDEX idx_album_meta_id (album_meta_id),
+    INDEX idx_duration_changed (duration_changed)
 );
 
 -- Weekly top 16 to store playlist tracks
 CREATE TABLE IF NOT EXISTS weekly_top_16 (
     id INT AUTO_INCREMENT PRIMARY KEY,
     user VARCHAR(255) NOT NULL,
+    playlist_id VARCHAR(255) DEFAULT NULL,
+    snapshot_id INT DEFAULT NULL,
     pl_order INT NOT NULL,
     artist VARCHAR(255) NOT NULL,
     album VARCHAR(255) NOT NULL,
@@ -109,7 +124,8 @@ CREATE TABLE IF NOT EXISTS weekly_top_16 (
     bandcamp_url VARCHAR(255) DEFAULT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    INDEX idx_user (user),
+    INDEX idx_user_snapshot (user, snapshot_id),
+    INDEX idx_playlist_snapshot (playlist_id, snapshot_id, pl_order),
     INDEX idx_artist_album (artist, album)
 );
 
@@ -131,6 +147,40 @@ CREATE TABLE IF NOT EXISTS last_fm_data_update (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Last.fm incremental sync cursor (newest scrobble already stored per user)
+CREATE TABLE IF NOT EXISTS last_fm_sync_cursor (
+    user VARCHAR(255) NOT NULL PRIMARY KEY,
+    last_uts BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- One row per pipeline run; its id tags the weekly_top_16 snapshot written by that run
+CREATE TABLE IF NOT EXISTS pipeline_run (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    started_at DATETIME NOT NULL,
+    finished_at DATETIME DEFAULT NULL
+);
+
+-- Last processed last_fm_data.id for incremental pipeline stages
+CREATE TABLE IF NOT EXISTS pipeline_watermark (
+    stage VARCHAR(64) NOT NULL PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Per user, day, hour and album listening totals used for playlist ranking
+CREATE TABLE IF NOT EXISTS listening_rollup (
+    user VARCHAR(255) NOT NULL,
+    play_date DATE NOT NULL,
+    play_hour TINYINT NOT NULL,
+    album_meta_id INT NOT NULL,
+    plays INT NOT NULL DEFAULT 0,
+    -- Plays whose track duration wasn't known yet; priced once enrichment finds it
+    unpriced_plays INT NOT NULL DEFAULT 0,
+    duration_ms BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, play_date, play_hour, album_meta_id)
+);
+
 -- Sample data for testing (optional, comment out for production)
 -- INSERT INTO users (lastfm_id, email_address, approved) VALUES ('example_user', 'user@example.com', 'YES');
 -- INSERT INTO users_playlists (user_id, playlist_id, period) VALUES (1, 'spotify_playlist_id_here', 'WEEK');
@@ -0,0 +1,58 @@
+"""
+Microbenchmark of the per-search cost of matching Spotify results.
+
+Not collected by a plain pytest run; run it explicitly with
+    python -m pytest tests/bench_matching.py -s
+"""
+import time
+
+import pytest
+
+# One search's worth of results, like the 50 a track search returns
+RESULTS = [
+    {'name': f'Song Title {i}', 'artists': [{'name': f'Artist {i % 7}'}],
+     'album': {'name': f'Album Name Volume {i % 5}'}}
+    for i in range(50)
+]
+TARGET = ('Artist 3', 'Album Name Volume 4', 'Song Title 24')
+SEARCHES = 200
+
+
+def per_search(func):
+    """Average seconds per call of func over SEARCHES calls."""
+    start = time.perf_counter()
+    for _ in range(SEARCHES):
+        func()
+    return (time.perf_counter() - start) / SEARCHES
+
+
+@pytest.mark.parametrize('engine', ['token', 'fuzzy'])
+def test_bench_per_search_cost(app, monkeypatch, engine):
+    monkeypatch.setattr(app, 'MATCH_ENGINE', engine)
+
+    def clear_caches():
+        app.normalize_tokens.cache_clear()
+        app.fuzzy_tokens.cache_clear()
+
+    def is_match_per_result():
+        # One is_match call per result rebuilds the target every time
+        clear_caches()
+        for result in RESULTS:
+            app.is_match(result, *TARGET)
+
+    def best_match_cold():
+        clear_caches()
+        app.make_matcher(*TARGET).best_match(RESULTS)
+
+    def best_match_warm():
+        app.make_matcher(*TARGET).best_match(RESULTS)
+
+    assert app.make_matcher(*TARGET).best_match(RESULTS) is RESULTS[24]
+    timings = {
+        'is_match per result': per_search(is_match_per_result),
+        'best_match, cold cache': per_search(best_match_cold),
+        'best_match, warm cache': per_search(best_match_warm),
+    }
+    print(f"\n{engine} engine, {len(RESULTS)} results per search:")
+    for name, seconds in timings.items():
+        print(f"  {name:<24} {seconds * 1e6:10.1f} us/search")
@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main.py reads its settings and creates its API clients at import time; give it
+# placeholder credentials so importing it needs neither a .env nor the network
+os.environ.setdefault('SPOTIFY_CLIENT_ID', 'test-client-id')
+os.environ.setdefault('SPOTIFY_CLIENT_SECRET', 'test-client-secret')
+os.environ.setdefault('SPOTIFY_REDIRECT_URI', 'http://localhost:8888/callback')
+os.environ.setdefault('LASTFM_API_KEY', 'test-api-key')
+os.environ.setdefault('RESPONSE_CACHE_PATH', os.path.join(tempfile.mkdtemp(), 'response_cache.sqlite'))
+os.environ.setdefault('METRICS_PATH', '')
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app():
+    """The main module, skipping the test where its dependencies aren't installed."""
+    pytest.importorskip('MySQLdb')
+    pytest.importorskip('spotipy')
+    import main
+    return main
+
+
+
+@pytest.fixture
+def db(app):
+    """
+    A session on a freshly created music_inventory database, built from music-inventory-schema.sql.
+    Opt in with MUSIC_INVENTORY_TEST_DB=1 and the DB_* settings of a scratch MySQL server:
+    the music_inventory database there is dropped and recreated for every test.
+    """
+    if os.getenv('MUSIC_INVENTORY_TEST_DB') != '1':
+        pytest.skip('set MUSIC_INVENTORY_TEST_DB=1 to run the database tests')
+    with open(os.path.join(ROOT, 'music-inventory-schema.sql')) as f:
+        schema = '\n'.join(line for line in f if not line.lstrip().startswith('--'))
+    server = {key: value for key, value in app.DB_CONFIG.items() if key != 'db'}
+    conn = app.MySQLdb.Connection(**server)
+    cursor = conn.cursor()
+    cursor.execute('DROP DATABASE IF EXISTS music_inventory')
+    for statement in schema.split(';'):
+        if statement.strip():
+            cursor.execute(statement)
+    conn.close()
+
+    pool = app.DBPool(dict(server, db='music_inventory'), 1)
+    with pool.session() as session:
+        yield session
@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+
+class FakeCursor:
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def pool(app, monkeypatch):
+    """A two-connection pool over fake connections that fail their ping once marked stale."""
+
+    class FakeConnection:
+        def __init__(self):
+            self.stale = False
+            self.closed = False
+
+        def ping(self):
+            if self.stale:
+                raise app.MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+
+        def cursor(self):
+            return FakeCursor()
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    pool = app.DBPool({}, 2, timeout=0.05)
+    monkeypatch.setattr(pool, 'connect', FakeConnection)
+    return pool
+
+
+@pytest.fixture
+def refuse_connections(app, pool, monkeypatch):
+    def refuse():
+        raise app.MySQLdb.OperationalError(2003, "Can't connect to MySQL server")
+
+    return lambda: monkeypatch.setattr(pool, 'connect', refuse)
+
+
+def test_checkout_times_out_when_every_connection_is_held(app, pool):
+    held = [pool.checkout(), pool.checkout()]
+
+    with pytest.raises(app.PoolTimeoutError):
+        pool.checkout()
+    pool.checkin(held[0])
+    assert pool.checkout() is held[0]
+
+
+def test_waiting_checkout_gets_a_connection_checked_in_by_another_thread(pool):
+    held = [pool.checkout(), pool.checkout()]
+    pool.timeout = 5
+
+    threading.Timer(0.05, pool.checkin, (held[1],)).start()
+    assert pool.checkout() is held[1]
+
+
+def test_failed_reconnect_of_a_stale_connection_gives_its_slot_back(app, pool, refuse_connections):
+    stale = pool.checkout()
+    stale.stale = True
+    pool.checkin(stale)
+    refuse_connections()
+
+    with pytest.raises(app.MySQLdb.OperationalError):
+        pool.checkout()
+    assert stale.closed
+    assert pool.opened == 0
+
+
+def test_failed_session_reconnect_gives_its_slot_back_once(app, pool, refuse_connections):
+    with pytest.raises(app.MySQLdb.OperationalError):
+        with pool.session() as db:
+            refuse_connections()
+            db.reconnect()
+    assert pool.opened == 0
+
+
+def test_pool_is_never_smaller_than_the_workers_plus_main(app):
+    assert app.DB_POOL_SIZE >= app.PIPELINE_WORKERS + 1
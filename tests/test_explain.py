@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+USERS = 20
+ALBUMS = 40
+TRACKS_PER_ALBUM = 10
+SCROBBLES_PER_USER = 300
+
+
+def seed_listening_history(db):
+    """Enough users, albums and scrobbles that an index beats a scan of last_fm_data."""
+    db.executemany("INSERT INTO users (lastfm_id, email_address, approved) VALUES (%s, %s, 'YES')",
+                   [(f'user{u}', f'user{u}@example.com') for u in range(USERS)])
+    db.executemany("INSERT INTO last_fm_album_meta (artist, album) VALUES (%s, %s)",
+                   [(f'Artist {a}', f'Album {a}') for a in range(ALBUMS)])
+    db.executemany("INSERT INTO last_fm_track_meta (artist, album, track, duration_ms, album_meta_id) VALUES (%s, %s, %s, %s, %s)",
+                   [(f'Artist {a}', f'Album {a}', f'Track {t}', 200000, a + 1)
+                    for a in range(ALBUMS) for t in range(TRACKS_PER_ALBUM)])
+    now = datetime.now()
+    rows = []
+    for u in range(USERS):
+        for n in range(SCROBBLES_PER_USER):
+            track = (u * 7 + n) % (ALBUMS * TRACKS_PER_ALBUM)
+            album = track // TRACKS_PER_ALBUM
+            rows.append((str(u + 1), f'Artist {album}', f'Album {album}', f'Track {track % TRACKS_PER_ALBUM}',
+                         now - timedelta(hours=n * 5), track + 1, album + 1))
+    db.executemany("INSERT INTO last_fm_data (user, artist, album, track, date_time, track_meta_id, album_meta_id) "
+                   "VALUES (%s, %s, %s, %s, %s, %s, %s)", rows)
+    db.commit()
+    db.execute("ANALYZE TABLE last_fm_data")
+    db.fetchall()
+
+
+def test_playlist_queries_use_an_index_on_last_fm_data(app, db):
+    seed_listening_history(db)
+
+    assert app.explain_hot_queries(db, 1) is True
+
+
+
+def test_a_user_without_scrobbles_is_not_reported_as_indexed(app, db):
+    seed_listening_history(db)
+
+    assert app.explain_hot_queries(db, USERS + 1) is False
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+def scrobble(n, uts):
+    return {'artist': {'#text': f'Artist {n}'}, 'album': {'#text': f'Album {n}'},
+            'name': f'Track {n}', 'date': {'uts': str(uts)}}
+
+
+class StubLastfm:
+    """Local stand-in for user.getrecenttracks serving fixed pages, newest first like Last.fm."""
+
+    def __init__(self, pages, fail=None):
+        self.pages = pages
+        # page -> number of 500 responses to send before serving it
+        self.fail = dict(fail or {})
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+                stub.requests.append(query)
+                page = int(query['page'])
+                if stub.fail.get(page):
+                    stub.fail[page] -= 1
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = json.dumps({'recenttracks': {
+                    'track': stub.pages[page - 1],
+                    '@attr': {'page': str(page), 'totalPages': str(len(stub.pages)),
+                              'total': str(sum(len(p) for p in stub.pages))}}}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/2.0/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_lastfm(app, monkeypatch):
+    """Point lastfm_request at a stub server through a fresh session with fast retries."""
+    stubs = []
+
+    def start(pages, fail=None):
+        stub = StubLastfm(pages, fail)
+        stubs.append(stub)
+        monkeypatch.setattr(app, 'LASTFM_API_URL', stub.url)
+        return stub
+
+    monkeypatch.setitem(app.HTTP_HOST_RATES, '127.0.0.1', 1000)
+    monkeypatch.setattr(app, 'HTTP_BACKOFF_BASE', 0.01)
+    monkeypatch.setattr(app, 'http', app.RateLimitedSession(4))
+    yield start
+    for stub in stubs:
+        stub.close()
+
+
+def test_fetches_every_page_in_page_order(app, stub_lastfm):
+    now_playing = dict(scrobble(0, 0), **{'@attr': {'nowplaying': 'true'}})
+    del now_playing['date']
+    pages = [
+        [now_playing, scrobble(1, 1700000300), scrobble(2, 1700000200)],
+        [scrobble(3, 1700000100)],
+        [scrobble(4, 1700000050), scrobble(5, 1700000000)],
+    ]
+    stub = stub_lastfm(pages)
+
+    rows, num_pages, total_tracks, max_uts = app.fetch_recent_tracks('someone', 7, 1600000000, 1800000000)
+
+    assert num_pages == 3
+    assert total_tracks == 6
+    assert max_uts == 1700000300
+    # The now-playing entry has no date and is skipped
+    assert [row[2] for row in rows] == ['Track 1', 'Track 2', 'Track 3', 'Track 4', 'Track 5']
+    assert all(row[4] == 7 for row in rows)
+    assert sorted(int(q['page']) for q in stub.requests) == [1, 2, 3]
+    assert all(q['from'] == '1600000000' and q['to'] == '1800000000' for q in stub.requests)
+
+
+def test_retries_a_failing_page(app, stub_lastfm):
+    stub = stub_lastfm([[scrobble(1, 1700000100)], [scrobble(2, 1700000000)]], fail={2: 2})
+
+    rows, num_pages, _, _ = app.fetch_recent_tracks('someone', 7, 1600000000, 1800000000)
+
+    assert num_pages == 2
+    assert [row[2] for row in rows] == ['Track 1', 'Track 2']
+    assert [int(q['page']) for q in stub.requests].count(2) == 3
+
+
+def test_a_page_that_keeps_failing_aborts_the_fetch(app, stub_lastfm):
+    stub_lastfm([[scrobble(1, 1700000100)], [scrobble(2, 1700000000)]], fail={2: 100})
+
+    with pytest.raises(app.requests.exceptions.HTTPError):
+        app.fetch_recent_tracks('someone', 7, 1600000000, 1800000000)
+
+
+def test_a_row_shifted_onto_the_next_page_is_kept_once(app, stub_lastfm):
+    # Track 2 ends page 1 and, after a shift, also starts page 2
+    stub_lastfm([[scrobble(1, 1700000200), scrobble(2, 1700000100)],
+                 [scrobble(2, 1700000100), scrobble(3, 1700000000)]])
+
+    rows, _, _, _ = app.fetch_recent_tracks('someone', 7, 1600000000, 1800000000)
+
+    assert [row[2] for row in rows] == ['Track 1', 'Track 2', 'Track 3']
+
+
+def test_a_window_refresh_replaces_todays_stored_scrobbles(app, db, stub_lastfm):
+    now = int(time.time())
+    stored = datetime.fromtimestamp(now - 60).strftime('%Y-%m-%d %H:%M:%S')
+    db.execute("INSERT INTO last_fm_data (user, artist, album, track, date_time) VALUES ('7', 'Artist 1', 'Album 1', 'Track 1', %s)", (stored,))
+    db.commit()
+    # The fetch runs to the time of the request, so it returns the stored scrobble again
+    stub_lastfm([[scrobble(2, now - 30), scrobble(1, now - 60)]])
+
+    app.update_lastfm_data(db, '7', 'someone', 'WEEK', 'ALL', 'YES', '0', None, 'playlist', None)
+
+    db.execute("SELECT track FROM last_fm_data WHERE user = '7' ORDER BY date_time")
+    assert [row[0] for row in db.fetchall()] == ['Track 1', 'Track 2']
@@ -0,0 +1,56 @@
+# (album, track, duration_ms); each track is played once in the same hour
+TRACKS = [
+    ('Priced', 'One', 200000),
+    ('Pending', 'Two', 0),
+    ('', 'No Album', 0),
+]
+
+
+def seed(db):
+    for a, (album, track, duration_ms) in enumerate(TRACKS, start=1):
+        db.execute("INSERT INTO last_fm_album_meta (id, artist, album) VALUES (%s, 'Artist', %s)", (a, album))
+        db.execute("INSERT INTO last_fm_track_meta (artist, album, track, duration_ms, album_meta_id) "
+                   "VALUES ('Artist', %s, %s, %s, %s)", (album, track, duration_ms, a))
+        db.execute("INSERT INTO last_fm_data (user, artist, album, track, date_time, track_meta_id, album_meta_id) "
+                   "VALUES ('1', 'Artist', %s, %s, '2024-05-01 10:15:00', LAST_INSERT_ID(), %s)", (album, track, a))
+    db.commit()
+
+
+def rollup(db):
+    db.execute("SELECT album_meta_id, plays, unpriced_plays, duration_ms FROM listening_rollup ORDER BY album_meta_id")
+    return [tuple(int(v) for v in row) for row in db.fetchall()]
+
+
+def test_only_plays_enrichment_can_price_are_left_unpriced(app, db):
+    seed(db)
+
+    app.update_listening_rollup(db)
+
+    # A track without an album is never enriched, so its plays stay at 0 ms instead of waiting for a price
+    assert rollup(db) == [(1, 1, 0, 200000), (2, 1, 1, 0), (3, 1, 0, 0)]
+
+
+def test_reprice_fills_in_durations_found_by_enrichment(app, db):
+    seed(db)
+    app.update_listening_rollup(db)
+    db.execute("UPDATE last_fm_track_meta SET duration_ms = 180000 WHERE track = 'Two'")
+    db.commit()
+
+    app.reprice_listening_rollup(db)
+
+    assert rollup(db) == [(1, 1, 0, 200000), (2, 1, 0, 180000), (3, 1, 0, 0)]
+
+
+def test_reprice_follows_a_duration_that_changes_after_it_was_priced(app, db):
+    seed(db)
+    app.update_listening_rollup(db)
+    app.reprice_listening_rollup(db)
+    # An imputed average is later replaced by the duration Spotify reports
+    db.execute("UPDATE last_fm_track_meta SET duration_ms = 215000 WHERE track = 'One'")
+    db.commit()
+
+    app.reprice_listening_rollup(db)
+
+    assert rollup(db) == [(1, 1, 0, 215000), (2, 1, 1, 0), (3, 1, 0, 0)]
+    db.execute("SELECT COUNT(*) FROM last_fm_track_meta WHERE duration_changed = 1")
+    assert db.fetchone()[0] == 0
@@ -0,0 +1,69 @@
+import pytest
+
+# Labeled corpus: (target artist, album, track), (result artist, album, track), whether it is the same recording
+CORPUS = [
+    # Same recording, spelled the same or folded to the same
+    (('Radiohead', 'OK Computer', 'Airbag'), ('Radiohead', 'OK Computer', 'Airbag'), True),
+    (('Beyonce', 'Lemonade', 'Hold Up'), ('Beyoncé', 'Lemonade', 'Hold Up'), True),
+    (('Sigur Ros', 'Agaetis byrjun', 'Svefn-g-englar'), ('Sigur Rós', 'Ágætis byrjun', 'Svefn-g-englar'), True),
+    (('Beatles', 'Abbey Road', 'Come Together'), ('The Beatles', 'Abbey Road (Remastered)', 'Come Together - Remastered 2009'), True),
+    (('The Beatles', 'Revolver', 'Taxman'), ('The Beatles', 'Revolver (Super Deluxe Edition)', 'Taxman'), True),
+    (('AC/DC', 'Back in Black', 'Hells Bells'), ('ACDC', 'Back In Black', "Hell's Bells"), True),
+    (('Florence + The Machine', 'Lungs', 'Dog Days Are Over'), ('Florence and the Machine', 'Lungs', 'Dog Days Are Over'), True),
+    (('Guns N Roses', 'Appetite for Destruction', 'Paradise City'), ("Guns N' Roses", 'Appetite For Destruction', 'Paradise City'), True),
+    (('Nirvana', 'Nevermind', 'Smells Like Teen Spirt'), ('Nirvana', 'Nevermind', 'Smells Like Teen Spirit'), True),
+    (('Björk', 'Homogenic', 'Jóga'), ('Björk', 'Homogenic', 'Joga'), True),
+    (('Pink Floyd', 'The Wall', 'Another Brick in the Wall, Pt. 2'), ('Pink Floyd', 'The Wall', 'Another Brick in the Wall, Pt. 2'), True),
+    # Numbered parts, volumes and sequels are different recordings
+    (('Foo', 'Live', 'Song Part 1'), ('Foo', 'Live', 'Song Part 2'), False),
+    (('Pink Floyd', 'The Wall', 'Another Brick in the Wall, Pt. 1'), ('Pink Floyd', 'The Wall', 'Another Brick in the Wall, Pt. 2'), False),
+    (('Pink Floyd', 'The Wall', 'Another Brick in the Wall, Pt. 2'), ('Pink Floyd', 'The Wall', 'Another Brick in the Wall, Pt. 3'), False),
+    (('Beethoven', 'Symphonies', 'Symphony No 5 Movement 1'), ('Beethoven', 'Symphonies', 'Symphony No 5 Movement 2'), False),
+    (('Rocky', 'Soundtrack', 'Theme II'), ('Rocky', 'Soundtrack', 'Theme III'), False),
+    (('Arcade Fire', 'Neighborhoods', 'Neighborhood #1 (Tunnels)'), ('Arcade Fire', 'Neighborhoods', 'Neighborhood #2 (Laika)'), False),
+    (('Kendrick Lamar', 'Untitled', 'Part One'), ('Kendrick Lamar', 'Untitled', 'Part Two'), False),
+    (('Sleep', 'Volume One', 'Dragonaut'), ('Sleep', 'Volume Two', 'Dragonaut'), False),
+    (('Shadows', 'Greatest Hits Vol. 1', 'Apache'), ('Shadows', 'Greatest Hits Vol. 2', 'Apache'), False),
+    (('Band', 'Album', 'Halloween'), ('Band', 'Album', 'Halloween II'), False),
+    # Different artists with nearly the same name
+    (('Beach House', 'Bloom', 'Myth'), ('Beach Houses', 'Bloom', 'Myth'), False),
+    (('The Verve', 'Urban Hymns', 'Lucky Man'), ('The Verve Pipe', 'Urban Hymns', 'Lucky Man'), False),
+    (('Prince', 'Purple Rain', 'Purple Rain'), ('Princess', 'Purple Rain', 'Purple Rain'), False),
+    # Different songs with overlapping titles
+    (('The Beatles', 'Please Please Me', 'Love Me Do'), ('The Beatles', 'Please Please Me', 'P.S. I Love You'), False),
+    (('Queen', 'A Night at the Opera', 'Love of My Life'), ('Queen', 'A Night at the Opera', 'Death on Two Legs'), False),
+    (('Artist', 'Album', 'Run'), ('Artist', 'Album', 'Run Away'), False),
+]
+
+
+def result(artist, album, track):
+    return {'name': track, 'artists': [{'name': artist}], 'album': {'name': album}}
+
+
+@pytest.mark.parametrize('target, candidate, expected', CORPUS,
+                         ids=[f"{c[0][2]} vs {c[1][0]} - {c[1][2]}" for c in CORPUS])
+def test_fuzzy_matcher_corpus(app, target, candidate, expected):
+    assert app.FuzzyMatcher(*target).matches(result(*candidate)) is expected
+
+
+def test_fuzzy_matcher_transliterates_non_latin_names(app):
+    pytest.importorskip('unidecode')
+    matcher = app.FuzzyMatcher('Kino', 'Gruppa krovi', 'Gruppa krovi')
+    assert matcher.matches(result('Кино', 'Группа крови', 'Группа крови'))
+
+
+def test_best_match_prefers_the_closest_album(app):
+    matcher = app.FuzzyMatcher('Radiohead', 'OK Computer', 'Airbag')
+    results = [result('Radiohead', 'OK Computer OKNOTOK 1997 2017', 'Airbag'),
+               result('Radiohead', 'OK Computer', 'Airbag')]
+    assert matcher.best_match(results) is results[1]
+
+
+@pytest.mark.parametrize('album, candidate, expected', [
+    ('Abbey Road', 'Abbey Road (Remastered)', True),
+    ('Greatest Hits Vol. 1', 'Greatest Hits Vol. 2', False),
+    ('Volume One', 'Volume Two', False),
+])
+def test_fuzzy_matcher_album_corpus(app, album, candidate, expected):
+    matcher = app.FuzzyMatcher('Artist', album, '')
+    assert matcher.matches_album({'name': candidate, 'artists': [{'name': 'Artist'}]}) is expected
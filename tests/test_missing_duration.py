@@ -0,0 +1,86 @@
+import pytest
+
+# (album, [(track, duration_ms)]); every track has one scrobble, 0 means the duration is unknown
+ALBUMS = [
+    ('Known', [('One', 200000), ('Two', 300000), ('Three', 0)]),
+    ('Unknown', [('Four', 0), ('Five', 0)]),
+    ('Half', [('Six', 100000), ('Seven', 0)]),
+]
+
+
+class NoSpotify:
+    def search(self, *args, **kwargs):
+        raise RuntimeError('offline')
+
+
+@pytest.fixture
+def offline(app, monkeypatch):
+    """No duration is found online, so missing_duration falls through to its averages."""
+    def no_lastfm(params):
+        raise RuntimeError('offline')
+
+    monkeypatch.setattr(app, 'sp', NoSpotify())
+    monkeypatch.setattr(app, 'lastfm_request', no_lastfm)
+
+
+def bandcamp_page(*tracks):
+    return {'track': {'itemListElement': [{'item': {'name': name, 'duration': duration}} for name, duration in tracks]}}
+
+
+def test_bandcamp_durations_keep_non_latin_track_names_apart(app):
+    durations = app.bandcamp_track_durations(bandcamp_page(('夜に駆ける', 'P00H04M21S'), ('群青', 'P00H04M09S'), ('???', 'P00H01M00S')))
+
+    def lookup(track):
+        return durations.get(app.fuzzy_tokens(track)[0])
+
+    assert lookup('夜に駆ける') == 261000
+    assert lookup('群青') == 249000
+    assert lookup('アイドル') is None
+    assert lookup('Кукушка') is None
+    # A name with nothing left after folding matches nothing
+    assert '' not in durations
+
+
+def seed(db):
+    for a, (album, tracks) in enumerate(ALBUMS, start=1):
+        db.execute("INSERT INTO last_fm_album_meta (id, artist, album) VALUES (%s, 'Artist', %s)", (a, album))
+        for track, duration_ms in tracks:
+            db.execute("INSERT INTO last_fm_track_meta (artist, album, track, duration_ms, album_meta_id) "
+                       "VALUES ('Artist', %s, %s, %s, %s)", (album, track, duration_ms, a))
+            db.execute("INSERT INTO last_fm_data (user, artist, album, track, date_time, track_meta_id, album_meta_id) "
+                       "VALUES ('1', 'Artist', %s, %s, NOW(), LAST_INSERT_ID(), %s)", (album, track, a))
+    db.commit()
+
+
+def durations(db):
+    db.execute("SELECT track, duration_ms FROM last_fm_track_meta")
+    return dict(db.fetchall())
+
+
+def test_unknown_durations_get_the_average_of_known_ones(app, db, offline):
+    seed(db)
+
+    app.missing_duration(db)
+    db.uow.flush()
+
+    # The old per-track loop averaged over every track of the album, zeros included, and
+    # filled tracks one at a time so earlier guesses fed later averages. It gave Three
+    # (200000 + 300000 + 0) / 3 = 166667 and left the all-unknown album at 0 ms.
+    # Now each album's average counts only known durations, and an album with none gets
+    # the average over all known durations: (200000 + 300000 + 100000) / 3 = 200000.
+    assert durations(db) == {
+        'One': 200000, 'Two': 300000, 'Three': 250000,
+        'Four': 200000, 'Five': 200000,
+        'Six': 100000, 'Seven': 100000,
+    }
+
+
+def test_only_the_given_albums_are_filled(app, db, offline):
+    seed(db)
+
+    app.missing_duration(db, [2])
+    db.uow.flush()
+
+    filled = durations(db)
+    assert filled['Four'] == filled['Five'] == 200000
+    assert filled['Three'] == 0 and filled['Seven'] == 0
@@ -0,0 +1,55 @@
+import pytest
+
+
+class FakeUnitOfWork:
+    def __init__(self):
+        self.writes = []
+
+    def execute(self, sql, params=None):
+        self.writes.append((sql, params))
+
+
+class FakeDB:
+    def __init__(self):
+        self.uow = FakeUnitOfWork()
+
+
+class CountingSpotify:
+    """Answers every search with one unrelated track."""
+
+    def __init__(self):
+        self.searches = 0
+
+    def search(self, q, type, limit):
+        self.searches += 1
+        return {'tracks': {'items': [{'id': 'x', 'name': 'Something Else',
+                                      'artists': [{'name': 'Someone Else'}],
+                                      'album': {'id': 'y', 'name': 'Another Album'}}]}}
+
+
+@pytest.fixture
+def spotify(app, monkeypatch, tmp_path):
+    spotify = CountingSpotify()
+    monkeypatch.setattr(app, 'sp', spotify)
+    monkeypatch.setattr(app, 'response_cache', app.ResponseCache(str(tmp_path / 'cache.sqlite'), 1000))
+    return spotify
+
+
+def test_the_relaxed_search_reuses_the_strict_search_results(app, spotify):
+    db = FakeDB()
+
+    assert app.search_spotify(db, 'Artist', 'Album', 'Track', 1, strict=True) is False
+    assert app.search_spotify(db, 'Artist', 'Album', 'Track', 1, strict=False) is False
+
+    assert spotify.searches == 1
+
+
+def test_a_scheduled_retry_asks_spotify_again(app, spotify):
+    db = FakeDB()
+    app.search_spotify(db, 'Artist', 'Album', 'Track', 1, strict=True)
+    app.search_spotify(db, 'Artist', 'Album', 'Track', 1, strict=False)
+
+    # The backoff retry days later runs the same two searches
+    app.search_spotify(db, 'Artist', 'Album', 'Track', 1, strict=True)
+
+    assert spotify.searches == 2